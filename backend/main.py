@@ -8,8 +8,8 @@ import os
 import sys
 import logging
 import json
-import json as json_lib
 import asyncio
+from contextlib import asynccontextmanager
 from pathlib import Path
 from dotenv import load_dotenv
 import time
@@ -28,6 +28,7 @@ sys.path.insert(0, str(Path(__file__).parent))
 
 from services import vton, gemini, shop, analyze_clothing, analyze_user
 from services import preprocess_clothing
+from services.http_clients import close_gemini_client
 from services.image_normalize import normalize_image_bytes, ensure_heif_registered
 
 load_dotenv()
@@ -39,7 +40,14 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="IGetDressed.Online API")
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    yield
+    # Close shared pooled HTTP clients on shutdown.
+    await close_gemini_client()
+
+
+app = FastAPI(title="IGetDressed.Online API", lifespan=lifespan)
 
 # Add a small “which stack served this response?” marker + request correlation id to all responses.
 @app.middleware("http")
@@ -437,10 +445,7 @@ async def try_on(
         metadata = None
         if garment_metadata:
             # #region agent log
-            try:
-                with open('/Users/gerardgrenville/Change Room/.cursor/debug.log', 'a') as f:
-                    f.write(json_lib.dumps({"location":"main.py:241","message":"Before metadata parsing","data":{"metadataType":type(garment_metadata).__name__,"metadataLength":len(str(garment_metadata)) if isinstance(garment_metadata,str) else None},"timestamp":int(__import__('time').time()*1000),"sessionId":"debug-session","runId":"run1","hypothesisId":"D"})+"\n")
-            except: pass
+            vton._agent_log("main.py:241", "Before metadata parsing", {"metadataType":type(garment_metadata).__name__,"metadataLength":len(str(garment_metadata)) if isinstance(garment_metadata,str) else None}, "D")
             # #endregion
             try:
                 import json
@@ -450,18 +455,12 @@ async def try_on(
                 else:
                     metadata = garment_metadata
                 # #region agent log
-                try:
-                    with open('/Users/gerardgrenville/Change Room/.cursor/debug.log', 'a') as f:
-                        f.write(json_lib.dumps({"location":"main.py:247","message":"Metadata parsing succeeded","data":{"metadataKeys":list(metadata.keys()) if isinstance(metadata,dict) else None},"timestamp":int(__import__('time').time()*1000),"sessionId":"debug-session","runId":"run1","hypothesisId":"D"})+"\n")
-                except: pass
+                vton._agent_log("main.py:247", "Metadata parsing succeeded", {"metadataKeys":list(metadata.keys()) if isinstance(metadata,dict) else None}, "D")
                 # #endregion
             except Exception as e:
                 logger.warning(f"Could not parse garment_metadata: {e}")
                 # #region agent log
-                try:
-                    with open('/Users/gerardgrenville/Change Room/.cursor/debug.log', 'a') as f:
-                        f.write(json_lib.dumps({"location":"main.py:250","message":"Metadata parsing failed","data":{"error":str(e)},"timestamp":int(__import__('time').time()*1000),"sessionId":"debug-session","runId":"run1","hypothesisId":"D"})+"\n")
-                except: pass
+                vton._agent_log("main.py:250", "Metadata parsing failed", {"error":str(e)}, "D")
                 # #endregion
                 # Try to clean smart quotes if present
                 try:
@@ -492,10 +491,7 @@ async def try_on(
         result_url = None
         try:
             # #region agent log
-            try:
-                with open('/Users/gerardgrenville/Change Room/.cursor/debug.log', 'a') as f:
-                    f.write(json_lib.dumps({"location":"main.py:267","message":"Calling vton.generate_try_on","data":{"category":final_category,"clothingFilesCount":len(clothing_image_files),"hasMetadata":metadata is not None},"timestamp":int(__import__('time').time()*1000),"sessionId":"debug-session","runId":"run1","hypothesisId":"E"})+"\n")
-            except: pass
+            vton._agent_log("main.py:267", "Calling vton.generate_try_on", {"category":final_category,"clothingFilesCount":len(clothing_image_files),"hasMetadata":metadata is not None}, "E")
             # #endregion
             result = await vton.generate_try_on(
                 user_image_files, 
@@ -508,10 +504,7 @@ async def try_on(
             )
             result_url = result.get("image_url") if isinstance(result, dict) else result
             # #region agent log
-            try:
-                with open('/Users/gerardgrenville/Change Room/.cursor/debug.log', 'a') as f:
-                    f.write(json_lib.dumps({"location":"main.py:273","message":"vton.generate_try_on succeeded","data":{"hasResultUrl":result_url is not None,"resultUrlLength":len(result_url) if result_url else 0},"timestamp":int(__import__('time').time()*1000),"sessionId":"debug-session","runId":"run1","hypothesisId":"E"})+"\n")
-            except: pass
+            vton._agent_log("main.py:273", "vton.generate_try_on succeeded", {"hasResultUrl":result_url is not None,"resultUrlLength":len(result_url) if result_url else 0}, "E")
             # #endregion
             logger.info(f"Try-on completed successfully. Result URL: {result_url}")
         finally:
@@ -537,10 +530,7 @@ async def try_on(
         error_detail = str(e)
         error_type = type(e).__name__
         # #region agent log
-        try:
-            with open('/Users/gerardgrenville/Change Room/.cursor/debug.log', 'a') as f:
-                f.write(json_lib.dumps({"location":"main.py:286","message":"Backend try-on endpoint error","data":{"errorType":error_type,"errorMessage":error_detail,"hasApiKeyError":"GEMINI_API_KEY" in error_detail or "GOOGLE_API_KEY" in error_detail},"timestamp":int(__import__('time').time()*1000),"sessionId":"debug-session","runId":"run1","hypothesisId":"A"})+"\n")
-        except: pass
+        vton._agent_log("main.py:286", "Backend try-on endpoint error", {"errorType":error_type,"errorMessage":error_detail,"hasApiKeyError":"GEMINI_API_KEY" in error_detail or "GOOGLE_API_KEY" in error_detail}, "A")
         # #endregion
         logger.error(f"Error in try-on endpoint: {error_type}: {error_detail}", exc_info=True)
         # Provide more helpful error messages
@@ -5,7 +5,8 @@ import json
 import re
 import logging
 import hashlib
-from typing import Dict, Any, Optional
+from types import MappingProxyType
+from typing import Dict, Any, Mapping, Optional
 from PIL import Image
 from PIL.ExifTags import TAGS, GPSTAGS
 import io
@@ -14,6 +15,31 @@ from .image_normalize import normalize_image_bytes_with_budget
 
 logger = logging.getLogger(__name__)
 
+# Guardrail-safe wording for the analysis output (see _sanitize_text in analyze_clothing).
+_ANALYSIS_REPLACEMENTS: Mapping[str, str] = MappingProxyType({
+    "lingerie": "delicate apparel",
+    "lingerie top": "delicate top",
+    "intimate": "delicate",
+    "intimates": "delicates",
+    "underwear": "base layer",
+    "bra": "structured top",
+    "bralette": "structured top",
+    "bustier": "structured top",
+    "corset": "structured top",
+    "sheer": "lightweight",
+    "see-through": "semi-sheer",
+    "transparent": "semi-sheer",
+    "mesh": "lightweight mesh",
+})
+# One case-insensitive pass over whole words (longest term first, optional plural "s"), so
+# "bralette" is not caught by "bra" and replacement text is never rescanned.
+_ANALYSIS_TERMS_RE = re.compile(
+    r"\b(?:"
+    + "|".join(re.escape(term) for term in sorted(_ANALYSIS_REPLACEMENTS, key=len, reverse=True))
+    + r")(?=s?\b)",
+    re.IGNORECASE,
+)
+
 
 def _extract_specific_item_type(description: str, category: str) -> str:
     """
@@ -175,25 +201,7 @@ async def analyze_clothing_item(image_bytes: bytes, original_filename: str = "")
         """
         if not isinstance(value, str):
             return value
-        replacements = {
-            "lingerie": "delicate apparel",
-            "lingerie top": "delicate top",
-            "intimate": "delicate",
-            "intimates": "delicates",
-            "underwear": "base layer",
-            "bra": "structured top",
-            "bralette": "structured top",
-            "bustier": "structured top",
-            "corset": "structured top",
-            "sheer": "lightweight",
-            "see-through": "semi-sheer",
-            "transparent": "semi-sheer",
-            "mesh": "lightweight mesh",
-        }
-        sanitized = value
-        for old, new in replacements.items():
-            sanitized = re.sub(old, new, sanitized, flags=re.IGNORECASE)
-        return sanitized
+        return _ANALYSIS_TERMS_RE.sub(lambda m: _ANALYSIS_REPLACEMENTS[m.group(0).lower()], value)
 
     def _sanitize_value(value):
         """
@@ -229,7 +237,7 @@ async def analyze_clothing_item(image_bytes: bytes, original_filename: str = "")
         elif out_mime == "image/webp":
             mime_type = "webp"
 
-        image_base64 = base64.b64encode(normalized_bytes).decode('utf-8')
+        image_base64 = base64.b64encode(normalized_bytes).decode('ascii')
         
         prompt = """
         You are an expert clothing classifier. Your ONLY job is to identify what clothing item is in this image and classify it correctly.
@@ -5,7 +5,8 @@ import base64
 import io
 import re
 from PIL import Image
-import httpx
+
+from .http_clients import encode_json_body, get_gemini_client
 
 logger = logging.getLogger(__name__)
 
@@ -41,7 +42,7 @@ async def analyze_user_attributes(image_files):
                 img = Image.open(io.BytesIO(img_bytes))
                 buffer = io.BytesIO()
                 img.save(buffer, format='JPEG', quality=85)
-                b64_data = base64.b64encode(buffer.getvalue()).decode('utf-8')
+                b64_data = base64.b64encode(buffer.getvalue()).decode('ascii')
                 
                 image_parts.append({
                     "inline_data": {
@@ -74,38 +75,39 @@ async def analyze_user_attributes(image_files):
         """
         
         # Call Gemini 1.5 Flash
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={api_key}",
-                headers={"Content-Type": "application/json"},
-                json={
-                    "contents": [{
-                        "role": "user",
-                        "parts": [{"text": prompt}] + image_parts
-                    }],
-                    "generationConfig": {
-                        "response_mime_type": "application/json"
-                    }
+        client = get_gemini_client()
+        response = await client.post(
+            f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={api_key}",
+            headers={"Content-Type": "application/json"},
+            timeout=30.0,
+            content=encode_json_body({
+                "contents": [{
+                    "role": "user",
+                    "parts": [{"text": prompt}] + image_parts
+                }],
+                "generationConfig": {
+                    "response_mime_type": "application/json"
                 }
-            )
-            
-            if not response.is_success:
-                logger.error(f"User analysis failed: {response.status_code} - {response.text}")
-                return {}
-                
-            data = response.json()
-            text_response = data.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text', '')
+            }),
+        )
+        
+        if not response.is_success:
+            logger.error(f"User analysis failed: {response.status_code} - {response.text}")
+            return {}
             
-            # Clean and parse JSON
-            try:
-                # Remove any potential markdown blocks if the model ignored the instruction
-                text_response = re.sub(r'```json\s*|\s*```', '', text_response)
-                attributes = json.loads(text_response)
-                logger.info(f"User analysis complete: {attributes}")
-                return attributes
-            except json.JSONDecodeError:
-                logger.error(f"Failed to parse user analysis JSON: {text_response}")
-                return {}
+        data = response.json()
+        text_response = data.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text', '')
+        
+        # Clean and parse JSON
+        try:
+            # Remove any potential markdown blocks if the model ignored the instruction
+            text_response = re.sub(r'```json\s*|\s*```', '', text_response)
+            attributes = json.loads(text_response)
+            logger.info(f"User analysis complete: {attributes}")
+            return attributes
+        except json.JSONDecodeError:
+            logger.error(f"Failed to parse user analysis JSON: {text_response}")
+            return {}
 
     except Exception as e:
         logger.error(f"Error in user analysis: {e}", exc_info=True)
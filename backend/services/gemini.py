@@ -5,7 +5,8 @@ import json
 import re
 import logging
 from PIL import Image
-import httpx
+
+from .http_clients import encode_json_body, get_gemini_client
 
 logger = logging.getLogger(__name__)
 
@@ -44,7 +45,7 @@ async def analyze_garment(image_bytes):
         buffer = io.BytesIO()
         # Save as PNG for consistency (Gemini handles PNG well)
         image.save(buffer, format='PNG')
-        image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+        image_base64 = base64.b64encode(buffer.getvalue()).decode('ascii')
         
         prompt = """
         Analyze this clothing item. Provide:
@@ -72,73 +73,74 @@ async def analyze_garment(image_bytes):
         # Try different API versions if one fails
         last_error = None
         response = None
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            for endpoint in endpoints:
-                try:
-                    response = await client.post(
-                        f"{endpoint}?key={api_key}",
-                        headers={
-                            "Content-Type": "application/json",
-                        },
-                        json={
-                            "contents": [
-                                {
-                                    "role": "user",
-                                    "parts": [
-                                        {"text": prompt},
-                                        {
-                                            "inline_data": {
-                                                "mime_type": "image/png",
-                                                "data": image_base64
-                                            }
+        client = get_gemini_client()
+        for endpoint in endpoints:
+            try:
+                response = await client.post(
+                    f"{endpoint}?key={api_key}",
+                    headers={
+                        "Content-Type": "application/json",
+                    },
+                    timeout=60.0,
+                    content=encode_json_body({
+                        "contents": [
+                            {
+                                "role": "user",
+                                "parts": [
+                                    {"text": prompt},
+                                    {
+                                        "inline_data": {
+                                            "mime_type": "image/png",
+                                            "data": image_base64
                                         }
-                                    ]
-                                }
-                            ]
-                        },
-                    )
-                    
-                    if not response.is_success:
-                        error_text = response.text
-                        logger.warning(f"Gemini API error with {endpoint.split('/')[-2]}: {response.status_code} - {error_text}")
-                        last_error = {"error": f"Gemini API error: {response.status_code}", "details": error_text}
-                        response = None  # Reset response so we know it failed
-                        continue
-                    
-                    # Success - break out of loop
-                    break
-                except Exception as e:
-                    logger.warning(f"Error calling {endpoint.split('/')[-2]}: {e}")
-                    last_error = {"error": str(e)}
+                                    }
+                                ]
+                            }
+                        ]
+                    }),
+                )
+                
+                if not response.is_success:
+                    error_text = response.text
+                    logger.warning(f"Gemini API error with {endpoint.split('/')[-2]}: {response.status_code} - {error_text}")
+                    last_error = {"error": f"Gemini API error: {response.status_code}", "details": error_text}
                     response = None  # Reset response so we know it failed
                     continue
-            
-            # If all endpoints failed, return error
-            if not response or last_error:
-                logger.error(f"All Gemini API endpoints failed. Last error: {last_error}")
-                return last_error if last_error else {"error": "All Gemini API endpoints failed"}
-            
-            data = response.json()
-            
-            # Extract text from response
-            parts = data.get("candidates", [{}])[0].get("content", {}).get("parts", [])
-            text = ""
-            for part in parts:
-                if "text" in part:
-                    text = part["text"]
-                    break
-            
-            if not text:
-                logger.warning(f"No text in Gemini response. Response: {json.dumps(data, indent=2)}")
-                return {"error": "No text returned from Gemini", "raw": data}
-            
-            # Parse JSON from response
-            match = re.search(r'\{.*\}', text, re.DOTALL)
-            if match:
-                return json.loads(match.group(0))
-            else:
-                logger.warning(f"Could not parse Gemini response as JSON. Raw: {text}")
-                return {"error": "Could not parse Gemini response", "raw": text}
+                
+                # Success - break out of loop
+                break
+            except Exception as e:
+                logger.warning(f"Error calling {endpoint.split('/')[-2]}: {e}")
+                last_error = {"error": str(e)}
+                response = None  # Reset response so we know it failed
+                continue
+        
+        # If all endpoints failed, return error
+        if not response or last_error:
+            logger.error(f"All Gemini API endpoints failed. Last error: {last_error}")
+            return last_error if last_error else {"error": "All Gemini API endpoints failed"}
+        
+        data = response.json()
+        
+        # Extract text from response
+        parts = data.get("candidates", [{}])[0].get("content", {}).get("parts", [])
+        text = ""
+        for part in parts:
+            if "text" in part:
+                text = part["text"]
+                break
+        
+        if not text:
+            logger.warning(f"No text in Gemini response. Response: {json.dumps(data, indent=2)}")
+            return {"error": "No text returned from Gemini", "raw": data}
+        
+        # Parse JSON from response
+        match = re.search(r'\{.*\}', text, re.DOTALL)
+        if match:
+            return json.loads(match.group(0))
+        else:
+            logger.warning(f"Could not parse Gemini response as JSON. Raw: {text}")
+            return {"error": "Could not parse Gemini response", "raw": text}
 
     except Exception as e:
         logger.error(f"Error analyzing garment: {e}", exc_info=True)
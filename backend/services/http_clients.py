@@ -0,0 +1,72 @@
+"""
+Shared HTTP clients.
+
+One pooled httpx.AsyncClient for all Gemini REST calls in this process. Reusing it keeps TCP/TLS
+connections to generativelanguage.googleapis.com alive between retry attempts and across requests,
+and multiplexes concurrent requests over HTTP/2 when the h2 package is installed.
+"""
+
+import json
+import logging
+from typing import Any, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Optional: orjson emits UTF-8 bytes directly and encodes multi-MB base64 strings much faster.
+# (services.vton logs the install hint when it is missing.)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # type: ignore  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+_GEMINI_CLIENT: Optional[httpx.AsyncClient] = None
+
+
+def get_gemini_client() -> httpx.AsyncClient:
+    """
+    Return the shared Gemini client, creating it on first use (or after close_gemini_client).
+    Creation has no await, so concurrent callers on the event loop cannot race to build two clients.
+    Callers needing a shorter deadline pass timeout= on the individual request.
+    """
+    global _GEMINI_CLIENT
+    if _GEMINI_CLIENT is None or _GEMINI_CLIENT.is_closed:
+        _GEMINI_CLIENT = httpx.AsyncClient(
+            http2=_http2_available(),
+            limits=httpx.Limits(max_keepalive_connections=100, max_connections=1000),
+            # 5 minute read timeout for image generation; fail fast if the API is unreachable.
+            timeout=httpx.Timeout(300.0, connect=10.0),
+        )
+    return _GEMINI_CLIENT
+
+
+async def close_gemini_client() -> None:
+    """Close the shared Gemini client (called from the FastAPI lifespan on shutdown)."""
+    global _GEMINI_CLIENT
+    if _GEMINI_CLIENT is not None:
+        await _GEMINI_CLIENT.aclose()
+        _GEMINI_CLIENT = None
+
+
+def encode_json_body(payload: Any) -> bytes:
+    """
+    Serialize a request body to compact UTF-8 JSON bytes for client.post(content=...).
+    Uses orjson when available (falling back for values it cannot encode), else stdlib json.
+    """
+    if ORJSON_AVAILABLE:
+        try:
+            return orjson.dumps(payload)
+        except TypeError:
+            pass
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
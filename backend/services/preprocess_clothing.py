@@ -167,7 +167,7 @@ async def analyze_single_clothing_image(
         )
 
     # Convert to base64
-    image_base64 = base64.b64encode(normalized_bytes).decode('utf-8')
+    image_base64 = base64.b64encode(normalized_bytes).decode('ascii')
     
     # Improved system prompt with explicit definitions
     system_prompt = """You are a fashion classifier for a virtual try on app.
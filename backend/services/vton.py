@@ -3,18 +3,74 @@ import asyncio
 import logging
 import base64
 import io
+import functools
 import json
+import math
+import random
 import re
-import copy
-from typing import Any, Dict, List, Optional, Tuple, Union
+import hashlib
+import atexit
+import queue
+import threading
+import logging.handlers
+from collections import OrderedDict
+from time import monotonic as _monotonic, time_ns as _time_ns
+from types import MappingProxyType
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Mapping, Optional, Tuple, Union
 from PIL import Image, ImageOps
 import httpx
 
+from .http_clients import encode_json_body, get_gemini_client
+
 logger = logging.getLogger(__name__)
 
+# orjson parses Gemini image responses (multi-MB base64 payloads) several times faster than stdlib json.
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+    logger.warning("orjson not installed. Falling back to stdlib json for Gemini responses. Install with: pip install orjson")
+
+try:
+    import pybase64
+    PYBASE64_AVAILABLE = True
+except ImportError:
+    PYBASE64_AVAILABLE = False
+    logger.warning("pybase64 not installed. Falling back to stdlib base64 for image payloads. Install with: pip install pybase64")
+
 # This module uses direct REST API calls to Gemini API with API key authentication.
 # No SDKs or OAuth2 are required - just set GEMINI_API_KEY (or GOOGLE_API_KEY) environment variable.
 
+def _trie_pattern(words: Iterable[str]) -> str:
+    """
+    Regex source matching any of the (lowercased) words, factored as a prefix trie:
+    ["bra", "bralette", "bikini"] -> "b(?:ikini|ra(?:lette)?)".
+
+    At each position the regex engine follows one trie path instead of trying every alternative,
+    so matching cost no longer grows with the keyword count. Greedy optionals try the longest word
+    first and back off to shorter ones, the same order as a longest-first alternation.
+    """
+    trie: Dict[str, Any] = {}
+    for word in words:
+        node = trie
+        for ch in word.lower():
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def render(node: Dict[str, Any]) -> str:
+        branches = [re.escape(ch) + render(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        terminal = "" in node
+        if len(branches) == 1 and not terminal:
+            return branches[0]
+        group = "(?:" + "|".join(branches) + ")"
+        return group + "?" if terminal else group
+
+    return render(trie)
+
+
 CONTENT_REJECTION_FINISH_REASONS = {"IMAGE_SAFETY", "SAFETY", "CONTENT_FILTER", "PROHIBITED_CONTENT"}
 CONTENT_REJECTION_KEYWORDS = [
     "image_safety",
@@ -31,6 +87,8 @@ CONTENT_REJECTION_KEYWORDS = [
     "nudity",
     "explicit",
 ]
+# All rejection keywords in one case-insensitive pass (substring match, like the keyword list).
+_CONTENT_REJECTION_RE = re.compile(_trie_pattern(CONTENT_REJECTION_KEYWORDS), re.IGNORECASE)
 
 INTIMATE_KEYWORDS = [
     "lingerie",
@@ -49,6 +107,33 @@ INTIMATE_KEYWORDS = [
     "transparent",
     "fishnet",
 ]
+# First-garment categories that cannot be intimate apparel: the vision preflight is skipped for these.
+# (Body-region categories such as lower_body stay checked: they include swim and underwear bottoms.)
+_NON_INTIMATE_CATEGORIES = frozenset({
+    "shoes", "footwear", "accessories", "bag", "bags", "hat", "hats", "jewelry",
+    "outerwear", "jacket", "coat",
+})
+# All intimate keywords in one case-insensitive substring pass (trie-shaped, like the rejection keywords).
+_INTIMATE_KEYWORDS_RE = re.compile(_trie_pattern(INTIMATE_KEYWORDS), re.IGNORECASE)
+
+
+def _contains_intimate_keyword(value: Any) -> bool:
+    """
+    True if any dict key or string leaf of value contains an intimate keyword (case-insensitive
+    substring). Walks the structure iteratively and stops at the first hit.
+    """
+    stack = [value]
+    while stack:
+        v = stack.pop()
+        if isinstance(v, str):
+            if _INTIMATE_KEYWORDS_RE.search(v) is not None:
+                return True
+        elif isinstance(v, dict):
+            stack.extend(v.keys())
+            stack.extend(v.values())
+        elif isinstance(v, (list, tuple)):
+            stack.extend(v)
+    return False
 
 
 def is_content_rejection(
@@ -66,11 +151,10 @@ def is_content_rejection(
     if fr in CONTENT_REJECTION_FINISH_REASONS:
         return True
 
-    # Some Gemini errors return 400/403 with policy text.
-    if http_status in (400, 403, 422):
-        text = (error_text or "").lower()
-        if any(k in text for k in CONTENT_REJECTION_KEYWORDS):
-            return True
+    # Some Gemini errors return 400/403 with policy text; the keyword scan is done once, here.
+    keyword_hit = bool(error_text) and _CONTENT_REJECTION_RE.search(error_text) is not None
+    if http_status in (400, 403, 422) and keyword_hit:
+        return True
 
     # Safety ratings sometimes include categories/thresholds even when finishReason isn't set.
     if safety_ratings:
@@ -87,8 +171,170 @@ def is_content_rejection(
             pass
 
     # Fallback: keyword scan
-    text = (error_text or "").lower()
-    return any(k in text for k in CONTENT_REJECTION_KEYWORDS)
+    return keyword_hit
+
+
+# Keep this conservative; we want to avoid generating explicit phrases, but allow neutral guidance.
+# Terms both sanitizers rewrite the same way; read-only so the shared tables cannot drift at runtime.
+_MODESTY_REPLACEMENTS: Mapping[str, str] = MappingProxyType({
+    "lingerie": "intimate apparel",
+    "thong": "minimal undergarment",
+    "bra": "supportive top",
+    "panties": "undergarments",
+    "nude": "neutral tone",
+    "see-through": "semi-transparent",
+    "transparent": "semi-transparent",
+    "sheer": "semi-transparent",
+    "fetish": "specialty",
+    "bondage": "restraint-style",
+    "stripper": "dance wear",
+    "pole dancing": "fitness wear",
+    "provocative": "bold",
+    "sexy": "stylish",
+    "seductive": "elegant",
+    "risque": "daring",
+    "cleavage": "neckline area",
+})
+
+# Clothing-description sanitizer: the shared modesty terms plus garment-specific wording.
+_CLOTHING_DESCRIPTION_REPLACEMENTS: Mapping[str, str] = MappingProxyType({
+    **_MODESTY_REPLACEMENTS,
+    'lingerie top': 'delicate top',
+    'intimate': 'delicate',
+    'intimates': 'delicates',
+    'bodysuit': 'one-piece outfit',
+    'one-piece': 'one-piece outfit',
+    'one piece': 'one-piece outfit',
+    'unitard': 'one-piece outfit',
+    'leotard': 'one-piece outfit',
+    'catsuit': 'one-piece outfit',
+    'swimsuit': 'swim outfit',
+    'bathing suit': 'swim outfit',
+    'monokini': 'swim outfit',
+    'trikini': 'swim outfit',
+    'lacy': 'delicate fabric',
+    'revealing': 'fitted',
+    'low-cut': 'neckline',
+    'plunging': 'v-neck',
+    'bikini': 'swimwear',
+    'micro': 'minimal',
+    'cropped': 'short',
+    'bodycon': 'form-fitting',
+    'skinny': 'fitted',
+    'tight': 'fitted',
+    'busty': 'full-figured',
+    'naughty': 'playful',
+    'slutty': 'fashionable',
+    'trashy': 'casual',
+    'skimpy': 'minimalist',
+    'barely there': 'minimal coverage',
+    'flesh-colored': 'neutral tone',
+    'mesh': 'open-weave',
+    'fishnet': 'patterned',
+    'dominatrix': 'bold fashion',
+    'latex': 'shiny material',
+    'leather': 'textured material',
+    'PVC': 'synthetic material',
+    'corset': 'structured top',
+    'bustier': 'fitted bodice',
+    'chemise': 'nightwear',
+    'teddy': 'lingerie set',
+    'camisole': 'light top',
+    'bralette': 'supportive top',
+    'thongs': 'minimal undergarments',
+    'boy shorts': 'short underwear',
+    'garter': 'accessory',
+    'stockings': 'hosiery',
+    'pantyhose': 'legwear',
+    'tights': 'leggings',
+    'high heels': 'heels',
+    'stilettos': 'high heels',
+    'platform': 'elevated shoes',
+    'burlesque': 'performance wear',
+})
+
+_CLOTHING_TERMS_RE = re.compile(
+    # Trie order tries "lingerie top" before "lingerie"; a trailing plural "s" is left in place.
+    r"\b" + _trie_pattern(_CLOTHING_DESCRIPTION_REPLACEMENTS) + r"(?=s?\b)",
+    re.IGNORECASE,
+)
+
+
+def _resolve_clothing_replacement(term: str, replacement: str) -> str:
+    """
+    Sanitize a replacement that itself contains listed terms ("teddy" -> "lingerie set" -> "delicate apparel set"),
+    so one pass over the input is enough. Expansions that keep the matched term ("one-piece" ->
+    "one-piece outfit") are left alone to avoid growing without bound.
+    """
+    lookup = {old.lower(): new for old, new in _CLOTHING_DESCRIPTION_REPLACEMENTS.items()}
+
+    def substitute(match: "re.Match[str]") -> str:
+        matched = match.group(0).lower()
+        new = lookup[matched]
+        return match.group(0) if matched == term or matched in new else new
+
+    for _ in range(3):
+        resolved = _CLOTHING_TERMS_RE.sub(substitute, replacement)
+        if resolved == replacement:
+            break
+        replacement = resolved
+    return replacement
+
+
+_CLOTHING_TERM_LOOKUP: Dict[str, str] = {
+    old.lower(): _resolve_clothing_replacement(old.lower(), new)
+    for old, new in _CLOTHING_DESCRIPTION_REPLACEMENTS.items()
+}
+
+
+def _replace_clothing_term(match: "re.Match[str]") -> str:
+    matched = match.group(0)
+    new = _CLOTHING_TERM_LOOKUP[matched.lower()]
+    return new[:1].upper() + new[1:] if matched[:1].isupper() else new
+
+
+def _sanitize_clothing_description(description: Any) -> Any:
+    """
+    Sanitize clothing descriptions to avoid triggering content filters while maintaining recognizability.
+    Single case-insensitive pass over whole words; casing of the surrounding text is preserved.
+    """
+    if not isinstance(description, str):
+        return description
+    return _sanitize_clothing_text(description)
+
+
+# Metadata strings and item descriptors repeat across prompt rebuilds (retries, rewrites) and requests.
+@functools.lru_cache(maxsize=2048)
+def _sanitize_clothing_text(description: str) -> str:
+    return _CLOTHING_TERMS_RE.sub(_replace_clothing_term, description)
+
+
+# Heuristic rewrite: the shared modesty terms with its own wording where it differs.
+_HEURISTIC_REPLACEMENTS: Mapping[str, str] = MappingProxyType({
+    **_MODESTY_REPLACEMENTS,
+    "fishnet": "patterned fabric",
+})
+_HEURISTIC_REPLACEMENT_LOOKUP: Dict[str, str] = {old.lower(): new for old, new in _HEURISTIC_REPLACEMENTS.items()}
+# One alternation compiled at import: a single left-to-right scan replaces every term, and replacement
+# text is never rescanned (so "see-through" -> "semi-transparent" is not rewritten again by "transparent").
+# The trie pattern tries multi-word terms before their prefixes.
+_HEURISTIC_TERMS_RE = re.compile(
+    r"\b" + _trie_pattern(_HEURISTIC_REPLACEMENTS) + r"\b",
+    re.IGNORECASE,
+)
+
+
+def _replace_heuristic_term(match: "re.Match[str]") -> str:
+    return _HEURISTIC_REPLACEMENT_LOOKUP[match.group(0).lower()]
+
+
+def _heuristic_sanitize(text: str) -> str:
+    """One regex pass over all terms, then collapse whitespace with C-level split/join (same set as \\s)."""
+    return " ".join(_HEURISTIC_TERMS_RE.sub(_replace_heuristic_term, text).split())
+
+
+# Metadata strings repeat across rewrites and requests; each distinct one is sanitized once.
+_heuristic_sanitize_text = functools.lru_cache(maxsize=2048)(_heuristic_sanitize)
 
 
 def rewrite_for_modesty_heuristic(
@@ -102,40 +348,12 @@ def rewrite_for_modesty_heuristic(
     Does not remove wearing directives; it only sanitizes wording and adds more
     conservative framing instructions.
     """
-    safe_meta: Dict[str, Any] = copy.deepcopy(metadata) if isinstance(metadata, dict) else {}
-
-    def sanitize_text(s: str) -> str:
-        # Keep this conservative; we want to avoid generating explicit phrases, but allow neutral guidance.
-        replacements = {
-            "lingerie": "intimate apparel",
-            "thong": "minimal undergarment",
-            "bra": "supportive top",
-            "panties": "undergarments",
-            "nude": "neutral tone",
-            "see-through": "semi-transparent",
-            "transparent": "semi-transparent",
-            "sheer": "semi-transparent",
-            "fishnet": "patterned fabric",
-            "fetish": "specialty",
-            "bondage": "restraint-style",
-            "stripper": "dance wear",
-            "pole dancing": "fitness wear",
-            "provocative": "bold",
-            "sexy": "stylish",
-            "seductive": "elegant",
-            "risque": "daring",
-            "cleavage": "neckline area",
-        }
-        out = s
-        for old, new in replacements.items():
-            out = re.sub(rf"\b{re.escape(old)}\b", new, out, flags=re.IGNORECASE)
-        # Remove extra whitespace
-        out = re.sub(r"\s+", " ", out).strip()
-        return out
+    # No deepcopy: sanitize_value below rebuilds every dict/list, so the caller's metadata is never mutated.
+    safe_meta: Dict[str, Any] = metadata if isinstance(metadata, dict) else {}
 
     def sanitize_value(v: Any) -> Any:
         if isinstance(v, str):
-            return sanitize_text(v)
+            return _heuristic_sanitize_text(v)
         if isinstance(v, list):
             return [sanitize_value(x) for x in v]
         if isinstance(v, dict):
@@ -163,10 +381,398 @@ def rewrite_for_modesty_heuristic(
             "fully opaque fabrics, and layered styling when uncertain."
         )
 
-    safe_prompt = sanitize_text(prompt) + guidance
+    # The prompt is long and differs per attempt, so it bypasses the string cache.
+    safe_prompt = _heuristic_sanitize(prompt) + guidance
     return safe_meta, safe_prompt, f"heuristic_rewrite(strictness={strictness})"
 
 
+# #region agent log
+_AGENT_LOG_PATH = os.getenv("VTON_DEBUG_LOG_PATH", '/Users/gerardgrenville/Change Room/.cursor/debug.log')
+# Constant fields shared by every debug-log record.
+_SESSION_ENVELOPE = {"sessionId": "debug-session", "runId": "run1"}
+# Read once at import: when off (the default), the log helpers below are bound to a no-op.
+_AGENT_LOG_ENABLED = os.getenv("VTON_DEBUG_LOG", "0") == "1"
+# (path, fd) of the debug log, opened once with O_APPEND so each record is a single os.write.
+_AGENT_LOG_FD: Optional[Tuple[str, int]] = None
+
+
+def _write_agent_log(text: str) -> None:
+    global _AGENT_LOG_FD
+    if _AGENT_LOG_FD is None or _AGENT_LOG_FD[0] != _AGENT_LOG_PATH:
+        fd = os.open(
+            _AGENT_LOG_PATH,
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_CLOEXEC", 0),
+            0o644,
+        )
+        if _AGENT_LOG_FD is not None:
+            try:
+                os.close(_AGENT_LOG_FD[1])
+            except OSError:
+                pass
+        _AGENT_LOG_FD = (_AGENT_LOG_PATH, fd)
+    os.write(_AGENT_LOG_FD[1], text.encode("utf-8"))
+
+
+class _AgentLogFileHandler(logging.Handler):
+    """Writes pre-serialized debug-log lines; runs on the QueueListener thread, off the event loop."""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            _write_agent_log(record.getMessage())
+        except Exception:
+            pass
+
+
+# When enabled, records go through a QueueHandler so the file write happens on a background thread.
+_AGENT_LOG_QUEUE_LOGGER: Optional[logging.Logger] = None
+if _AGENT_LOG_ENABLED:
+    _agent_log_queue: "queue.SimpleQueue[Any]" = queue.SimpleQueue()
+    _AGENT_LOG_QUEUE_LOGGER = logging.getLogger(f"{__name__}.agent_log")
+    _AGENT_LOG_QUEUE_LOGGER.propagate = False
+    _AGENT_LOG_QUEUE_LOGGER.setLevel(logging.DEBUG)
+    _AGENT_LOG_QUEUE_LOGGER.addHandler(logging.handlers.QueueHandler(_agent_log_queue))
+    _agent_log_listener = logging.handlers.QueueListener(_agent_log_queue, _AgentLogFileHandler())
+    _agent_log_listener.start()
+    atexit.register(_agent_log_listener.stop)
+
+
+def _emit_agent_log(text: str) -> None:
+    if _AGENT_LOG_QUEUE_LOGGER is not None:
+        _AGENT_LOG_QUEUE_LOGGER.debug(text)
+    else:
+        _write_agent_log(text)
+
+
+def _append_agent_log(
+    location: str,
+    message: str,
+    data: Dict[str, Any],
+    hypothesis_id: str,
+    ts_ms: Optional[int] = None,
+    buffer: Optional[List[str]] = None,
+) -> None:
+    """
+    Append one debug record; never raises. Pass ts_ms to reuse a timestamp computed once per attempt,
+    and buffer to collect lines for a single _flush_agent_log write instead of writing now.
+    """
+    try:
+        record = {
+            "location": location,
+            "message": message,
+            "data": data,
+            "timestamp": ts_ms if ts_ms is not None else _time_ns() // 1_000_000,
+            **_SESSION_ENVELOPE,
+            "hypothesisId": hypothesis_id,
+        }
+        line = _dumps_text(record) + "\n"
+        if buffer is not None:
+            buffer.append(line)
+            return
+        _emit_agent_log(line)
+    except Exception:
+        pass
+
+
+def _flush_agent_log_buffer(buffer: List[str]) -> None:
+    """Write buffered debug records with a single write; never raises."""
+    if not buffer:
+        return
+    try:
+        _emit_agent_log("".join(buffer))
+    except Exception:
+        pass
+    buffer.clear()
+
+
+def _agent_log_disabled(*_args: Any, **_kwargs: Any) -> None:
+    return None
+
+
+_agent_log = _append_agent_log if _AGENT_LOG_ENABLED else _agent_log_disabled
+_flush_agent_log = _flush_agent_log_buffer if _AGENT_LOG_ENABLED else _agent_log_disabled
+# #endregion
+
+
+def _loads_json(text: Union[str, bytes, bytearray]) -> Any:
+    """Parse JSON text or bytes (orjson when available; both raise a json.JSONDecodeError subclass)."""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def _response_json(resp: Any) -> Any:
+    """
+    Decode a Gemini HTTP response body as JSON.
+    Parses the raw bytes with orjson when available; falls back to resp.json().
+    """
+    content = getattr(resp, "content", None)
+    if ORJSON_AVAILABLE and isinstance(content, (bytes, bytearray)):
+        return orjson.loads(content)
+    return resp.json()
+
+
+# Responses at least this large are parsed with the inline image spliced out (see below).
+_INLINE_SPLIT_MIN_BYTES = 256 * 1024
+_INLINE_DATA_SENTINEL = "__vton_inline_data__"
+_INLINE_OBJECT_RE = re.compile(rb'"(?:inline_data|inlineData)"\s*:\s*\{')
+_INLINE_DATA_KEY_RE = re.compile(rb'"data"\s*:\s*"')
+
+
+def _split_inline_image(content: bytes) -> Tuple[bytes, Optional[memoryview]]:
+    """
+    Cut the first inline image's base64 string out of a raw Gemini JSON body.
+
+    Returns (body_with_sentinel, base64_view), the view pointing into content. The reduced body parses into a small dict whose
+    inline "data" value is _INLINE_DATA_SENTINEL, so the multi-MB payload is never materialized
+    as a Python str. Returns (content, None) when no inline image is found.
+    """
+    obj = _INLINE_OBJECT_RE.search(content)
+    if not obj:
+        return content, None
+    obj_end = content.find(b"}", obj.end())
+    key = _INLINE_DATA_KEY_RE.search(content, obj.end(), obj_end if obj_end != -1 else len(content))
+    if not key:
+        return content, None
+    start = key.end()
+    end = content.find(b'"', start)
+    # Base64 never contains quotes or escapes; anything else means this is not a plain payload.
+    if end == -1 or content.find(b"\\", start, end) != -1:
+        return content, None
+    # Slice through a memoryview: the multi-MB base64 is referenced in place, not copied.
+    view = memoryview(content)
+    body = b"".join((view[:start], _INLINE_DATA_SENTINEL.encode("ascii"), view[end:]))
+    return body, view[start:end]
+
+
+def _response_json_split_inline_image(resp: Any) -> Tuple[Any, Optional[memoryview]]:
+    """
+    Like _response_json, but for large bodies splices out the inline image first.
+    Returns (parsed_json, base64_view_or_None); see _split_inline_image.
+    """
+    content = getattr(resp, "content", None)
+    if isinstance(content, (bytes, bytearray)) and len(content) >= _INLINE_SPLIT_MIN_BYTES:
+        body, image_b64 = _split_inline_image(bytes(content))
+        if image_b64 is not None:
+            return _loads_json(body), image_b64
+    return _response_json(resp), None
+
+
+def _part_inline_data(part: Any) -> Optional[Dict[str, Any]]:
+    """Inline image dict of a response part: snake_case (Python API) or camelCase (JavaScript API)."""
+    if not isinstance(part, dict):
+        return None
+    return part.get("inline_data") or part.get("inlineData")
+
+
+def _inline_mime_type(inline: Dict[str, Any], default: str = "image/png") -> str:
+    return inline.get("mime_type") or inline.get("mimeType") or default
+
+
+def _summarize_response_json(data: Any) -> str:
+    """
+    Bounded, JSON-encoded summary of a Gemini response for logs/failure details.
+    Never stringifies the full body (which may embed a multi-MB base64 image).
+    """
+    if isinstance(data, dict):
+        summary: Dict[str, Any] = {
+            "keys": list(data)[:20],
+            "candidates": len(data.get("candidates") or []),
+        }
+        # promptFeedback carries the blockReason for prompt-level rejections; it is small.
+        if "promptFeedback" in data:
+            summary["promptFeedback"] = data.get("promptFeedback")
+    else:
+        summary = {"type": type(data).__name__}
+    try:
+        if ORJSON_AVAILABLE:
+            return orjson.dumps(summary).decode("utf-8")
+        return json.dumps(summary, ensure_ascii=False)
+    except (TypeError, ValueError):
+        return str(summary)[:1000]
+
+
+_ERROR_BODY_MAX_CHARS = 8192
+
+
+def _response_text_head(resp: Any, limit: int = _ERROR_BODY_MAX_CHARS) -> str:
+    """
+    Decode at most `limit` bytes of an error body. Slicing the raw bytes first avoids decoding
+    (and later logging/scanning) an arbitrarily large payload when only its head is ever used.
+    """
+    content = getattr(resp, "content", None)
+    if isinstance(content, (bytes, bytearray)):
+        return bytes(content[:limit]).decode("utf-8", "replace")
+    return (resp.text or "")[:limit]
+
+
+def _data_url_bytes(mime_type: str, image_base64: Union[bytes, memoryview]) -> bytes:
+    """ASCII bytes of a data URL for a base64 payload sliced from a raw body."""
+    return b"".join((b"data:", mime_type.encode("ascii"), b";base64,", image_base64))
+
+
+def _build_data_url(mime_type: str, image_base64: Union[str, bytes, memoryview]) -> str:
+    """
+    Build a data URL from a base64 payload without re-encoding it.
+    Accepts the payload as str (parsed JSON) or ASCII bytes / a memoryview (sliced from a raw body).
+    """
+    if isinstance(image_base64, str):
+        return "".join(("data:", mime_type, ";base64,", image_base64))
+    return _data_url_bytes(mime_type, image_base64).decode("ascii")
+
+
+def _retry_delay_s(attempt: int, *, base: float, cap: float = 30.0, jitter: float = 0.5) -> float:
+    """Exponential backoff with multiplicative jitter: base * 2^(attempt-1) * (1 + U[0, jitter)), capped."""
+    return min(cap, base * (2 ** (attempt - 1)) * (1 + random.random() * jitter))
+
+
+async def _sleep_before_retry(attempt: int, *, model_fault: bool = False, retry_after: Optional[str] = None) -> None:
+    """
+    Back off before the next Gemini attempt (callers skip this on the final attempt).
+    Network/HTTP failures use GEMINI_RETRY_BACKOFF_BASE_S; model-side failures (no image, non-STOP finish)
+    use the smaller GEMINI_RETRY_MODEL_BACKOFF_BASE_S. A numeric Retry-After header (429) takes precedence.
+    """
+    cap = 30.0
+    delay: Optional[float] = None
+    if retry_after:
+        try:
+            delay = min(cap, max(0.0, float(retry_after)))
+        except ValueError:
+            delay = None
+    if delay is None:
+        if model_fault:
+            base = float(os.getenv("GEMINI_RETRY_MODEL_BACKOFF_BASE_S", "0.2"))
+        else:
+            base = float(os.getenv("GEMINI_RETRY_BACKOFF_BASE_S", "1.0"))
+        delay = _retry_delay_s(attempt, base=base, cap=cap)
+    if delay > 0:
+        logger.info("Backing off %.2fs before Gemini attempt %d", delay, attempt + 1)
+        await asyncio.sleep(delay)
+
+
+# Request-independent part of the try-on prompt. It must stay free of per-request values (counts,
+# indices, metadata) so every generateContent call starts with the same prefix.
+_TRY_ON_STATIC_PREAMBLE = (
+    "You are a fashion virtual try-on engine. "
+    "Generate one photorealistic image of the person wearing all provided NEW clothing items. "
+    "OUTFIT PRESERVATION: For any clothing or accessories NOT provided in the new garments list, faithfully reproduce them from the Main Reference Image. "
+    "Replace ONLY the garments that conflict with the new items (e.g., new top replaces the old top, but keep the original pants/shoes if not replaced; a dress replaces both top and bottom). "
+    "BACKGROUND & POSE: Do NOT reuse the original background. Use a clean, neutral, flattering background. Do NOT lock the exact pose/angle—allow natural variation that still fits the person. "
+    "IDENTITY FIDELITY: All user images must be used to perfectly maintain the same face, hair, eyes, skin tone, and body shape/height impression in the final image. "
+    "Every user-specified wearing style or positioning instruction is mandatory and overrides any defaults. "
+    "Do not ignore, soften, or reinterpret those directives under any circumstance.\n\n"
+)
+
+def _normalize_instruction(value: Any) -> Optional[str]:
+    if isinstance(value, str):
+        cleaned = value.strip()
+        if cleaned:
+            return cleaned
+    return None
+
+
+def _extract_descriptor(item_info: Dict[str, Any], fallback_index: int) -> Any:
+    descriptor = (
+        item_info.get('descriptor')
+        or item_info.get('item_type')
+        or item_info.get('category')
+        or f"item {fallback_index + 1}"
+    )
+    if isinstance(descriptor, str):
+        descriptor = descriptor.strip()
+    return descriptor or f"item {fallback_index + 1}"
+
+
+# (user_attributes key, prompt label), in prompt order.
+_USER_ATTRIBUTE_LABELS = (
+    ("body_type", "Body Type"),
+    ("skin_tone", "Skin Tone"),
+    ("hair_color", "Hair"),
+    ("gender", "Gender Presentation"),
+    ("age_range", "Age Group"),
+)
+
+
+def _user_reference_prompt(
+    user_attributes: Optional[Dict[str, Any]],
+    user_quality_flags: Optional[List[Dict[str, Any]]],
+) -> str:
+    """Prompt fragment for low-resolution references and extracted user attributes (may be empty)."""
+    fragment = ""
+    if user_quality_flags:
+        low_res_count = sum(1 for f in user_quality_flags if f.get("low_res"))
+        if low_res_count > 0:
+            fragment += (
+                f"NOTE: Some user photos are lower resolution ({low_res_count}). "
+                "Prioritize the sharpest, best-lit reference when ensuring identity fidelity.\n"
+            )
+
+    # Inject extracted user attributes to reinforce identity
+    if user_attributes:
+        lines = ["\nPHYSICAL ATTRIBUTES (Reinforce these features found in the user images):\n"]
+        for key, label in _USER_ATTRIBUTE_LABELS:
+            if user_attributes.get(key):
+                lines.append(f"- {label}: {user_attributes[key]}\n")
+        lines.append("Ensure the generated person strictly adheres to these physical characteristics to maintain identity consistency.\n\n")
+        fragment += "".join(lines)
+    return fragment
+
+
+# Fixed prompt sections appended by build_base_text_prompt (identical for every attempt and request).
+_TRY_ON_SAFETY_GUIDELINES = (
+    "IMPORTANT SAFETY GUIDELINES: "
+    "Generate appropriate, tasteful fashion content only. "
+    "If any clothing appears potentially inappropriate, automatically modify it to be more modest and professional while maintaining the essential style and functionality. "
+    "Ensure all generated content complies with general audience standards. "
+    "Add subtle coverage or opacity as needed to maintain appropriateness without changing the garment's fundamental design."
+)
+_TRY_ON_MODESTY_CONTRACT = (
+    "\n\nMODESTY CONTRACT (MANDATORY): "
+    "This outfit may include intimate or minimal-coverage garments. "
+    "You MUST output a general-audience, tasteful fashion image. "
+    "If any garment is small, sheer, or revealing, automatically add opaque lining, increase coverage, "
+    "and/or add a simple underlayer (e.g., camisole, bralette lining, slip, bandeau, mesh base) "
+    "while keeping the garment recognizable. "
+    "Use conservative studio styling, avoid close-ups, avoid explicit emphasis, and keep pose neutral."
+)
+_TRY_ON_CONTENT_FILTER_SUFFIX = (
+    "\n\nCONTENT FILTER AVOIDANCE: "
+    "If this request involves any clothing that could be considered revealing or intimate, "
+    "automatically add subtle opacity, coverage, or conservative styling to ensure the generated image "
+    "meets general audience standards while preserving the garment's essential design and functionality. "
+    "Make tasteful modifications as needed without changing the fundamental garment type or purpose."
+)
+# Metadata keys rendered in their own prompt sections rather than in "Additional styling instructions".
+_WEARING_METADATA_KEYS = frozenset({
+    'wearing_instructions',
+    'items_wearing_styles',
+    'strict_wearing_enforcement',
+    'wearing_instruction_policy',
+    'wearing_instruction_summary',
+    'enforced_items_count',
+})
+# Suffix appended to the prompt on each retry attempt, escalating conservatism.
+_TRY_ON_RETRY_SUFFIXES = {
+    2: "\n\nRETRY: Keep output professional, conservative, and general-audience.",
+    3: "\n\nRETRY: Increase coverage and opacity; avoid close-ups; professional studio framing.",
+    4: "\n\nRETRY (MAX SAFETY): Default to conservative studio portrait; fully opaque fabrics; layered styling.",
+}
+
+# Rewrite applied after a content rejection on attempt N: (strategy, strictness) for attempt N + 1.
+_REWRITE_PLAN = {
+    1: ("heuristic", "moderate"),
+    2: ("gemini", "moderate"),
+    3: ("gemini", "max"),
+}
+
+_TRY_ON_GENERATION_CONFIG = {"responseModalities": ["TEXT", "IMAGE"]}
+_TRY_ON_SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_LOW_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
+
 async def _gemini_post_json(
     client: httpx.AsyncClient,
     *,
@@ -176,78 +782,272 @@ async def _gemini_post_json(
 ) -> httpx.Response:
     """
     Thin wrapper for Gemini HTTP calls to make retry logic testable (can be monkeypatched).
+    The body is serialized here (orjson when available): try-on payloads carry several MB of base64.
     """
-    return await client.post(url, headers=headers, json=payload)
+    return await client.post(
+        url,
+        headers={**headers, "Content-Type": "application/json"},
+        content=_encode_json_body(payload),
+    )
 
 
-async def rewrite_for_modesty_gemini(
+def _summarize_candidate(
+    candidate_obj: Dict[str, Any],
+) -> Tuple[Optional[str], List[Any], List[Any], Optional[Dict[str, Any]]]:
+    """
+    Return (finish_reason, safety_ratings, content_parts, image_inline) for one Gemini candidate.
+    The parts scan stops at the first inline image with data; text parts are only needed on
+    failure, see _candidate_texts.
+    """
+    finish_reason = candidate_obj.get("finishReason") or candidate_obj.get("finish_reason")
+    safety_ratings = candidate_obj.get("safetyRatings") or []
+    content_obj = candidate_obj.get("content", {}) or {}
+    parts = content_obj.get("parts", []) or []
+    image_inline = next(
+        (inline for inline in map(_part_inline_data, parts) if inline and inline.get("data")),
+        None,
+    )
+    return finish_reason, safety_ratings, parts, image_inline
+
+
+def _candidate_texts(parts: List[Any]) -> List[str]:
+    """Non-empty text parts of a candidate, in order."""
+    return [str(part["text"]) for part in parts if isinstance(part, dict) and part.get("text")]
+
+
+async def _call_gemini_once(
     client: httpx.AsyncClient,
     *,
-    api_key: str,
-    metadata: Optional[Dict[str, Any]],
-    prompt: str,
-    last_failure: Dict[str, Any],
-    strictness: str,
-) -> Tuple[Dict[str, Any], str, str]:
+    url: str,
+    payload: Dict[str, Any],
+    attempt: int,
+) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
     """
-    Gemini-only rewrite step (text-only) to reduce IMAGE_SAFETY/IMAGE_OTHER blocks.
+    One try-on generateContent call: POST, parse, extract the image.
 
-    Returns:
-      (new_metadata, prompt_additions, summary)
+    Returns (data_url, None) on success, or (None, failure) where failure["reason"] is one of
+    http_error / no_candidates / empty_image_data / no_image_or_finish_reason plus the fields the
+    retry loop needs to decide on a rewrite. Transport errors (timeouts etc.) propagate.
+    """
+    response = await _gemini_post_json(
+        client,
+        url=url,
+        headers={"Content-Type": "application/json"},
+        payload=payload,
+    )
+    if not response.is_success:
+        status_code = response.status_code
+        return None, {
+            "reason": "http_error",
+            "status": status_code,
+            "error_text": _response_text_head(response),
+            "retry_after": response.headers.get("Retry-After") if status_code == 429 and hasattr(response, "headers") else None,
+        }
 
-    Hardening:
-    - Strict JSON-only output request (best-effort; we still defensively parse)
-    - Short timeout; falls back to caller's heuristic logic on failure
-    - Caller should still apply a heuristic sanitization layer to the output
+    data, inline_image_b64 = _response_json_split_inline_image(response)
+    response_keys = list(data.keys()) if isinstance(data, dict) else None
+    candidates = data.get("candidates", []) if isinstance(data, dict) else []
+    if not candidates:
+        return None, {
+            "reason": "no_candidates",
+            "response_keys": response_keys,
+            "response_summary": _summarize_response_json(data),
+        }
+
+    finish_reason, safety_ratings, content_parts, image_part = _summarize_candidate(candidates[0])
+    if safety_ratings:
+        logger.warning("Safety ratings (attempt %d): %s", attempt, safety_ratings)
+    if finish_reason:
+        logger.info("Finish reason (attempt %d): %s", attempt, finish_reason)
+        if finish_reason != "STOP":
+            logger.warning("Unexpected finish reason (attempt %d): %s", attempt, finish_reason)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Number of parts in response: %d", len(content_parts))
+        for i, part in enumerate(content_parts):
+            logger.debug("Part %d keys: %s", i, list(part.keys()))
+            if "text" in part:
+                logger.debug("Part %d has text: %.100s", i, part.get('text', ''))
+
+    if image_part and finish_reason in (None, "STOP"):
+        image_base64 = image_part.get("data")
+        if image_base64 == _INLINE_DATA_SENTINEL:
+            image_base64 = inline_image_b64
+        if not image_base64:
+            return None, {"reason": "empty_image_data", "response_keys": response_keys, "finish_reason": finish_reason}
+
+        mime_type = _inline_mime_type(image_part)
+        if logger.isEnabledFor(logging.INFO):
+            b64_len = len(image_base64)
+            logger.info("   Image size: ~%d bytes (%d base64 chars), MIME type: %s", b64_len * 3 // 4, b64_len, mime_type)
+        if isinstance(image_base64, str):
+            # Release the raw body and parsed response before building the data URL so only
+            # the extracted base64 string and the URL are alive at the same time.
+            del response, data, candidates, content_parts, inline_image_b64
+            return _build_data_url(mime_type, image_base64), None
+        # image_base64 is a view into the raw body: join the URL bytes, release the body (and the
+        # view), then decode, so the payload is never held more than twice at once.
+        url_bytes = _data_url_bytes(mime_type, image_base64)
+        del response, data, candidates, content_parts, inline_image_b64, image_base64
+        return url_bytes.decode("ascii"), None
+
+    return None, {
+        "reason": "no_image_or_finish_reason",
+        "response_keys": response_keys,
+        "finish_reason": finish_reason,
+        "safety_ratings": safety_ratings,
+        "text_parts": _candidate_texts(content_parts),
+        "has_image": bool(image_part),
+        "parts_count": len(content_parts),
+    }
+
+
+async def _first_successful_attempt(
+    attempts: List[Tuple[int, Awaitable[Tuple[Optional[str], Optional[Dict[str, Any]]]]]],
+) -> Tuple[int, Optional[str], Optional[Dict[str, Any]]]:
+    """
+    Run _call_gemini_once coroutines concurrently, keyed by attempt number.
+
+    Returns (attempt, data_url, None) for the first call that produces an image and cancels the
+    others. If none does, returns the outcome of the highest attempt (re-raising its exception).
+    """
+    tasks = {asyncio.ensure_future(coro): attempt for attempt, coro in attempts}
+    finished: Dict[int, "asyncio.Future[Any]"] = {}
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result()[0] is not None:
+                    return tasks[task], task.result()[0], None
+                finished[tasks[task]] = task
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+    last = max(finished)
+    image_url, failure = finished[last].result()
+    return last, image_url, failure
+
+
+def _encode_json_body(payload: Any) -> bytes:
+    """Serialize a request body to compact UTF-8 JSON bytes (reusing a pre-encoded body when present)."""
+    if isinstance(payload, _PreencodedPayload):
+        return payload.encoded
+    return encode_json_body(payload)
+
+
+class _PreencodedPayload(dict):
+    """A request payload dict that also carries its already-serialized JSON body."""
+
+    __slots__ = ("encoded",)
+
+    def __init__(self, payload: Dict[str, Any], encoded: bytes):
+        super().__init__(payload)
+        self.encoded = encoded
+
+
+class _TextPayloadTemplate:
+    """
+    Serialize a payload once with a placeholder text and splice each new text into the bytes.
+    Try-on retries only change the prompt, so the multi-MB base64 image parts are encoded a single time.
+    """
+
+    _PLACEHOLDER = "\x00vton-text-placeholder\x00"
+
+    def __init__(self, build_payload: Callable[[str], Dict[str, Any]]):
+        self._build_payload = build_payload
+        body = _encode_json_body(build_payload(self._PLACEHOLDER))
+        self._prefix, _, self._suffix = body.partition(_encode_json_body(self._PLACEHOLDER))
+
+    def render(self, text: str) -> _PreencodedPayload:
+        encoded = b"".join((self._prefix, _encode_json_body(text), self._suffix))
+        return _PreencodedPayload(self._build_payload(text), encoded)
+
+
+def _dumps_text(value: Any, *, indent: bool = False) -> str:
+    """JSON-encode to str without ASCII escaping (orjson when available); indent=True uses 2 spaces."""
+    if ORJSON_AVAILABLE:
+        # Non-str keys and unknown types are handled natively, as the stdlib fallback does (default=str).
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        try:
+            return orjson.dumps(value, default=str, option=option).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(value, ensure_ascii=False, default=str, indent=2 if indent else None)
+
+
+_REWRITE_OUTPUT_SCHEMA = {
+    "prompt_additions": "string (short block of directives to append to the base prompt)",
+    "metadata": "object (revised metadata, preserve keys if possible)",
+    "changes": "array of short strings describing what changed",
+}
+_REWRITE_INSTRUCTION = (
+    "Rewrite the metadata and propose additional prompt directives to be more modest and less likely "
+    "to trigger safety filters."
+)
+# INPUT_JSON object for the rewrite call with the static fields encoded once; braces are doubled for str.format.
+_REWRITE_INPUT_TEMPLATE = (
+    '{{"instruction": ' + json.dumps(_REWRITE_INSTRUCTION, ensure_ascii=False).replace("{", "{{").replace("}", "}}")
+    + ', "strictness": {strictness}, "last_failure": {last_failure}, "prompt_context": {prompt_context}'
+    + ', "metadata": {metadata}, "output_schema": '
+    + json.dumps(_REWRITE_OUTPUT_SCHEMA, ensure_ascii=False).replace("{", "{{").replace("}", "}}")
+    + '}}'
+)
+
+
+# Batched variant: one INPUT_JSON holding several rewrite jobs, answered with a results list in the same order.
+_REWRITE_BATCH_INPUT_TEMPLATE = (
+    '{{"instruction": ' + json.dumps(
+        _REWRITE_INSTRUCTION + " Handle each job independently and return one result per job, in order.",
+        ensure_ascii=False,
+    ).replace("{", "{{").replace("}", "}}")
+    + ', "jobs": {jobs}, "output_schema": '
+    + json.dumps({"results": [_REWRITE_OUTPUT_SCHEMA]}, ensure_ascii=False).replace("{", "{{").replace("}", "}}")
+    + '}}'
+)
+# Opening fence (with optional language tag) and closing fence of a model reply, removed in one pass.
+_CODE_FENCE_RE = re.compile(r"\A```[a-zA-Z0-9_-]*\s*|\s*```\Z")
+_REWRITE_SYSTEM = (
+    "You are a safety compliance editor for a fashion virtual try-on system. "
+    "Your job is to rewrite METADATA and propose PROMPT_ADDITIONS to reduce image safety blocks "
+    "while keeping the outfit recognizable and professional. "
+    "Do NOT remove or weaken mandatory wearing directives. "
+    "Keep the output general-audience and modest. "
+    "Return ONLY valid JSON matching the schema."
+)
+_REWRITE_MAX_STRICTNESS = (
+    "MAXIMUM safety: conservative studio framing, avoid close-ups, ensure opacity/coverage, "
+    "and err on the side of layered styling."
+)
+
+
+async def _request_rewrite_json(
+    client: Optional[httpx.AsyncClient],
+    *,
+    api_key: str,
+    text: str,
+    max_output_tokens: int,
+) -> Tuple[Dict[str, Any], str]:
+    """
+    Send one text-only rewrite request and return (parsed JSON object, model name).
+    Raises RuntimeError (or asyncio.TimeoutError) when the reply is unusable.
     """
     if os.getenv("GEMINI_REWRITE_ENABLED", "1") != "1":
         raise RuntimeError("gemini_rewrite_disabled")
+    if client is None:
+        client = get_gemini_client()
 
     model_name = os.getenv("GEMINI_REWRITE_MODEL", "gemini-1.5-flash")
     base_url = "https://generativelanguage.googleapis.com/v1beta/models"
     endpoint = f"{base_url}/{model_name}:generateContent"
 
-    system = (
-        "You are a safety compliance editor for a fashion virtual try-on system. "
-        "Your job is to rewrite METADATA and propose PROMPT_ADDITIONS to reduce image safety blocks "
-        "while keeping the outfit recognizable and professional. "
-        "Do NOT remove or weaken mandatory wearing directives. "
-        "Keep the output general-audience and modest. "
-        "Return ONLY valid JSON matching the schema."
-    )
-    if strictness == "max":
-        system += (
-            " Apply MAXIMUM safety: conservative studio framing, avoid close-ups, ensure opacity/coverage, "
-            "and err on the side of layered styling."
-        )
-
-    schema = {
-        "prompt_additions": "string (short block of directives to append to the base prompt)",
-        "metadata": "object (revised metadata, preserve keys if possible)",
-        "changes": "array of short strings describing what changed",
-    }
-
-    user_payload = {
-        "instruction": "Rewrite the metadata and propose additional prompt directives to be more modest and less likely to trigger safety filters.",
-        "strictness": strictness,
-        "last_failure": last_failure,
-        "prompt_context": prompt,
-        "metadata": metadata or {},
-        "output_schema": schema,
-    }
-
-    text = (
-        system
-        + "\n\nINPUT_JSON:\n"
-        + json.dumps(user_payload, ensure_ascii=False)
-        + "\n\nOUTPUT: JSON ONLY. No markdown. No code fences."
-    )
-
     req = {
         "contents": [{"role": "user", "parts": [{"text": text}]}],
         "generationConfig": {
             "temperature": 0.0,
-            "maxOutputTokens": 900,
+            "maxOutputTokens": max_output_tokens,
             # Best-effort; some Gemini models honor this and will return raw JSON text.
             "responseMimeType": "application/json",
         },
@@ -266,7 +1066,7 @@ async def rewrite_for_modesty_gemini(
     if not resp.is_success:
         raise RuntimeError(f"gemini_rewrite_http_error:{resp.status_code}:{resp.text[:300]}")
 
-    data = resp.json() if hasattr(resp, "json") else {}
+    data = _response_json(resp) if hasattr(resp, "json") else {}
     candidates = (data or {}).get("candidates") or []
     if not candidates:
         raise RuntimeError("gemini_rewrite_no_candidates")
@@ -284,24 +1084,371 @@ async def rewrite_for_modesty_gemini(
 
     # Defensive: strip code fences if the model ignores the instruction.
     if out_text.startswith("```"):
-        out_text = re.sub(r"^```[a-zA-Z0-9_-]*\s*", "", out_text).strip()
-        out_text = re.sub(r"\s*```$", "", out_text).strip()
+        out_text = _CODE_FENCE_RE.sub("", out_text).strip()
 
-    parsed = json.loads(out_text)
-    if not isinstance(parsed, dict):
+    # Only an object is usable: reject other roots before parsing a possibly long garbled reply.
+    if not out_text.startswith("{"):
         raise RuntimeError("gemini_rewrite_non_object_json")
+    return _loads_json(out_text), model_name
+
 
+def _rewrite_result(
+    parsed: Dict[str, Any], metadata: Optional[Dict[str, Any]], *, label: str
+) -> Tuple[Dict[str, Any], str, str]:
+    """(new_metadata, prompt_additions, summary) from one parsed rewrite object; label prefixes the summary."""
     prompt_additions = str(parsed.get("prompt_additions") or "")
     new_meta_raw = parsed.get("metadata") or (metadata or {})
     new_meta = new_meta_raw if isinstance(new_meta_raw, dict) else (metadata or {})
     changes = parsed.get("changes") or []
     if not isinstance(changes, list):
         changes = []
+    return new_meta, prompt_additions, f"{label}, changes={changes[:4]})"
 
-    summary = f"gemini_rewrite(strictness={strictness}, model={model_name}, changes={changes[:4]})"
-    return new_meta, prompt_additions, summary
 
-async def generate_try_on(user_image_files, garment_image_files, category="upper_body", garment_metadata=None, user_attributes=None, main_index=0, user_quality_flags=None):
+async def rewrite_for_modesty_gemini(
+    client: Optional[httpx.AsyncClient] = None,
+    *,
+    api_key: str,
+    metadata: Optional[Dict[str, Any]],
+    prompt: str,
+    last_failure: Dict[str, Any],
+    strictness: str,
+) -> Tuple[Dict[str, Any], str, str]:
+    """
+    Gemini-only rewrite step (text-only) to reduce IMAGE_SAFETY/IMAGE_OTHER blocks.
+
+    Returns:
+      (new_metadata, prompt_additions, summary)
+
+    Hardening:
+    - Strict JSON-only output request (best-effort; we still defensively parse)
+    - Short timeout; falls back to caller's heuristic logic on failure
+    - Caller should still apply a heuristic sanitization layer to the output
+    - Uses the shared pooled client unless one is passed in
+    """
+    system = _REWRITE_SYSTEM
+    if strictness == "max":
+        system += " Apply " + _REWRITE_MAX_STRICTNESS
+
+    # Only the variable fields are serialized per call; instruction and schema are pre-encoded.
+    user_payload_json = _REWRITE_INPUT_TEMPLATE.format(
+        strictness=_dumps_text(strictness),
+        last_failure=_dumps_text(last_failure),
+        prompt_context=_dumps_text(prompt),
+        metadata=_dumps_text(metadata or {}),
+    )
+
+    text = (
+        system
+        + "\n\nINPUT_JSON:\n"
+        + user_payload_json
+        + "\n\nOUTPUT: JSON ONLY. No markdown. No code fences."
+    )
+
+    parsed, model_name = await _request_rewrite_json(client, api_key=api_key, text=text, max_output_tokens=900)
+    return _rewrite_result(parsed, metadata, label=f"gemini_rewrite(strictness={strictness}, model={model_name}")
+
+
+async def rewrite_for_modesty_gemini_batch(
+    client: Optional[httpx.AsyncClient] = None,
+    *,
+    api_key: str,
+    jobs: List[Dict[str, Any]],
+) -> List[Optional[Tuple[Dict[str, Any], str, str]]]:
+    """
+    Several rewrite_for_modesty_gemini jobs in one round trip. Each job is a dict with metadata,
+    prompt, last_failure and strictness. Returns one (new_metadata, prompt_additions, summary) per
+    job, in order, or None where the model's entry was unusable. Raises like the single call.
+    """
+    system = _REWRITE_SYSTEM
+    if any(job.get("strictness") == "max" for job in jobs):
+        system += " For jobs with strictness \"max\", apply " + _REWRITE_MAX_STRICTNESS
+
+    user_payload_json = _REWRITE_BATCH_INPUT_TEMPLATE.format(
+        jobs=_dumps_text([
+            {
+                "strictness": job.get("strictness"),
+                "last_failure": job.get("last_failure"),
+                "prompt_context": job.get("prompt"),
+                "metadata": job.get("metadata") or {},
+            }
+            for job in jobs
+        ]),
+    )
+    text = (
+        system
+        + "\n\nINPUT_JSON:\n"
+        + user_payload_json
+        + "\n\nOUTPUT: JSON ONLY. No markdown. No code fences."
+    )
+
+    parsed, model_name = await _request_rewrite_json(
+        client, api_key=api_key, text=text, max_output_tokens=900 * len(jobs)
+    )
+    results = parsed.get("results")
+    if not isinstance(results, list) or len(results) != len(jobs):
+        raise RuntimeError("gemini_rewrite_batch_size_mismatch")
+    return [
+        _rewrite_result(
+            entry,
+            job.get("metadata"),
+            label=f"gemini_rewrite_batch(strictness={job.get('strictness')}, model={model_name}",
+        )
+        if isinstance(entry, dict) else None
+        for job, entry in zip(jobs, results)
+    ]
+
+def _b64encode_str(data: Any) -> str:
+    """
+    Base64-encode bytes or any buffer (e.g. BytesIO.getbuffer(), avoiding a copy) to an ASCII str.
+    Uses SIMD-accelerated pybase64 when available; multi-MB images make this the dominant encode cost.
+    """
+    if PYBASE64_AVAILABLE:
+        return pybase64.b64encode_as_string(data)
+    return base64.b64encode(data).decode("ascii")
+
+
+# Per-thread scratch buffer for PIL re-encodes: image_to_base64 runs in to_thread workers, and the
+# budget loop re-encodes the same references several times, so reusing one grown BytesIO per worker
+# avoids repeated multi-MB allocations. Buffers that grew past the cap are not retained.
+_SCRATCH_BUFFER_MAX_RETAINED = 16 * 1024 * 1024
+_scratch_local = threading.local()
+
+
+def _scratch_buffer() -> io.BytesIO:
+    """Return this thread's empty scratch BytesIO (read it with getbuffer() before the next call)."""
+    buf = getattr(_scratch_local, "buffer", None)
+    if buf is not None:
+        try:
+            if buf.getbuffer().nbytes <= _SCRATCH_BUFFER_MAX_RETAINED:
+                buf.seek(0)
+                buf.truncate()
+                return buf
+        except BufferError:
+            # A view from the previous encode is still alive (e.g. held by a traceback).
+            pass
+    buf = io.BytesIO()
+    _scratch_local.buffer = buf
+    return buf
+
+
+_EXIF_ORIENTATION_TAG = 0x0112
+# Lossy inputs above this density (roughly JPEG quality 95+, or large embedded metadata) are re-encoded
+# rather than passed through: the re-encode at the target quality is several times smaller. Small files
+# are exempt because headers dominate their size.
+_PASSTHROUGH_MAX_BYTES_PER_PIXEL = 1.0
+_PASSTHROUGH_DENSITY_MIN_BYTES = 64 * 1024
+
+
+def _sniff_image_mime(image_bytes: bytes) -> Optional[str]:
+    """MIME type from magic bytes for the formats Gemini accepts as inline_data, else None."""
+    if image_bytes[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    if image_bytes[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    return None
+
+
+def _passthrough_image_mime(image_bytes: bytes, img: Any, *, max_dim: int) -> Optional[str]:
+    """
+    Return the MIME type if the original bytes can be sent as-is, i.e. re-encoding would not change
+    what the model sees: a native format, already within max_dim, upright (no EXIF rotation), in a
+    plain colour mode and not stored at a wastefully high quality. PNGs only pass through with
+    transparency (otherwise they are re-encoded as the much smaller JPEG). Only the header is
+    inspected; PIL decodes pixels lazily.
+    """
+    mime = _sniff_image_mime(image_bytes)
+    if mime is None:
+        return None
+    try:
+        width, height = img.size
+        if max(width, height) > max_dim:
+            return None
+        if (
+            mime != "image/png"
+            and len(image_bytes) > _PASSTHROUGH_DENSITY_MIN_BYTES
+            and len(image_bytes) > width * height * _PASSTHROUGH_MAX_BYTES_PER_PIXEL
+        ):
+            return None
+        if img.getexif().get(_EXIF_ORIENTATION_TAG, 1) != 1:
+            return None
+        if mime == "image/png":
+            has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in (img.info or {}))
+            return mime if has_alpha else None
+        return mime if img.mode in ("RGB", "RGBA", "L") else None
+    except Exception:
+        return None
+
+
+# Payload budget solver: approximate JPEG size ratio per quality point removed (q70-q90, photographs).
+_JPEG_BYTES_PER_QUALITY_STEP = 0.95
+# Aim a little under the budget so one re-encode usually lands within it.
+_BUDGET_SOLVER_HEADROOM = 0.95
+
+
+def _shrink_encode_targets(
+    targets: Mapping[str, int], *, min_main_user_dim: int, min_main_user_jpeg_quality: int
+) -> Dict[str, int]:
+    """One step of the reference shrink policy: secondary refs first, then the primary garment, main user last."""
+    return {
+        "other_user_dim": max(900, int(targets["other_user_dim"] * 0.85)),
+        "other_garment_dim": max(850, int(targets["other_garment_dim"] * 0.85)),
+        "other_user_q": max(70, targets["other_user_q"] - 4),
+        "other_garment_q": max(68, targets["other_garment_q"] - 4),
+        "first_garment_dim": max(1000, int(targets["first_garment_dim"] * 0.9)),
+        "first_garment_q": max(72, targets["first_garment_q"] - 3),
+        "main_user_dim": max(min_main_user_dim, int(targets["main_user_dim"] * 0.92)),
+        "main_user_q": max(min_main_user_jpeg_quality, targets["main_user_q"] - 2),
+    }
+
+
+def _predict_encoded_bytes(
+    measured: List[Tuple[int, Optional[int], str, str]],
+    measured_at: Mapping[str, int],
+    targets: Mapping[str, int],
+) -> float:
+    """
+    Predict the total encoded size at targets from sizes measured at measured_at, assuming bytes scale
+    with pixel area and drop by a fixed ratio per JPEG quality point. measured holds
+    (bytes, source longest side or None, dim key, quality key) per image.
+    """
+    total = 0.0
+    for size, side, dim_key, q_key in measured:
+        old_side = min(side, measured_at[dim_key]) if side else measured_at[dim_key]
+        new_side = min(side, targets[dim_key]) if side else targets[dim_key]
+        quality_steps = max(0, measured_at[q_key] - targets[q_key])
+        total += size * (new_side / old_side) ** 2 * _JPEG_BYTES_PER_QUALITY_STEP ** quality_steps
+    return total
+
+
+def _image_longest_side(image_bytes: bytes) -> Optional[int]:
+    """Longest side from the image header (no pixel decode), or None if unreadable."""
+    try:
+        return max(Image.open(io.BytesIO(image_bytes)).size)
+    except Exception:
+        return None
+
+
+def _prepare_intimate_detect_image(garment_bytes: bytes, *, max_dim: int) -> Tuple[str, str]:
+    """
+    Base64 JPEG for the intimate-garment preflight (blocking; run it in a thread). Kept lightweight:
+    downscale to max_dim and compress to reduce request size. Falls back to the raw bytes.
+    """
+    try:
+        img = Image.open(io.BytesIO(garment_bytes))
+        if img.format == "JPEG" and max(img.size) > max_dim:
+            # Reduced-scale JPEG decode (as in image_to_base64); the resize below finishes the job.
+            scale = max_dim / float(max(img.size))
+            img.draft(None, (math.ceil(img.size[0] * scale), math.ceil(img.size[1] * scale)))
+        img = ImageOps.exif_transpose(img)
+        w, h = img.size
+        longest = max(w, h)
+        if longest > max_dim:
+            scale = max_dim / float(longest)
+            img = img.resize((max(1, int(w * scale)), max(1, int(h * scale))), Image.Resampling.LANCZOS)
+        buf = _scratch_buffer()
+        img.convert("RGB").save(buf, format="JPEG", quality=70, optimize=True, progressive=True)
+        return _b64encode_str(buf.getbuffer()), "image/jpeg"
+    except Exception:
+        return _b64encode_str(garment_bytes), "image/jpeg"
+
+
+def _read_one_image(f: Any) -> bytes:
+    if hasattr(f, 'seek'):
+        f.seek(0)
+    return f.read() if hasattr(f, 'read') else f
+
+
+def _read_image_bytes(files: List[Any]) -> List[bytes]:
+    """Read file-like objects (rewound first) into bytes; raw bytes pass through unchanged."""
+    return [_read_one_image(f) for f in files]
+
+
+async def _read_image_bytes_async(files: List[Any]) -> List[bytes]:
+    """
+    Like _read_image_bytes, but reads backed by disk/network (anything other than bytes or BytesIO)
+    run concurrently in worker threads so they do not block the event loop.
+    """
+    if all(isinstance(f, (bytes, bytearray, io.BytesIO)) for f in files):
+        return _read_image_bytes(files)
+    return list(await asyncio.gather(*(asyncio.to_thread(_read_one_image, f) for f in files)))
+
+
+def _canonical_json_bytes(value: Any) -> bytes:
+    """Deterministic JSON encoding (sorted keys) used for cache keys."""
+    if ORJSON_AVAILABLE:
+        try:
+            return orjson.dumps(value, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass
+    return json.dumps(value, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+
+
+def _try_on_cache_key(
+    user_image_bytes_list: List[bytes],
+    garment_image_bytes_list: List[bytes],
+    *,
+    category: Optional[str],
+    garment_metadata: Any,
+    user_attributes: Any,
+    main_index: int,
+    user_quality_flags: Any,
+) -> str:
+    """Content-addressable key over every input that influences the generated image."""
+    h = hashlib.blake2b(digest_size=32)
+    for group in (user_image_bytes_list, garment_image_bytes_list):
+        h.update(len(group).to_bytes(4, "big"))
+        for image_bytes in group:
+            # Length-prefix each image so different splits of the same bytes never collide.
+            h.update(len(image_bytes).to_bytes(8, "big"))
+            h.update(image_bytes)
+    h.update(_canonical_json_bytes([category, garment_metadata, user_attributes, main_index, user_quality_flags]))
+    return h.hexdigest()
+
+
+# In-process LRU of successful try-on results: key -> (expires_at_monotonic, result).
+# Identical requests (user retries, replays) skip the Gemini call entirely.
+_RESULT_CACHE: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+
+def _result_cache_get(key: str) -> Optional[Dict[str, Any]]:
+    entry = _RESULT_CACHE.get(key)
+    if entry is None:
+        return None
+    expires_at, result = entry
+    if expires_at < _monotonic():
+        _RESULT_CACHE.pop(key, None)
+        return None
+    _RESULT_CACHE.move_to_end(key)
+    return result
+
+
+def _result_cache_put(key: str, result: Dict[str, Any]) -> None:
+    max_entries = int(os.getenv("VTON_RESULT_CACHE_SIZE", "16"))
+    if max_entries <= 0:
+        return
+    ttl_s = float(os.getenv("VTON_RESULT_CACHE_TTL_S", "86400"))
+    _RESULT_CACHE[key] = (_monotonic() + ttl_s, result)
+    _RESULT_CACHE.move_to_end(key)
+    while len(_RESULT_CACHE) > max_entries:
+        _RESULT_CACHE.popitem(last=False)
+
+
+# cache_key -> task generating that result; shared by concurrent identical requests.
+_INFLIGHT: Dict[str, "asyncio.Future[Dict[str, Any]]"] = {}
+
+
+def _inflight_done(key: str, task: "asyncio.Future[Dict[str, Any]]") -> None:
+    if _INFLIGHT.get(key) is task:
+        del _INFLIGHT[key]
+    # Mark a failure as retrieved even if every waiter was cancelled (avoids "never retrieved" noise).
+    if not task.cancelled():
+        task.exception()
+
+
+async def generate_try_on(user_image_files, garment_image_files, category="upper_body", garment_metadata=None, user_attributes=None, main_index=0, user_quality_flags=None, no_cache=False):
     """
     Uses Gemini 3 Pro (Nano Banana Pro) image editing to combine person and clothing images.
     Generates a photorealistic image of the person wearing all clothing items.
@@ -312,6 +1459,7 @@ async def generate_try_on(user_image_files, garment_image_files, category="upper
         category: Category of the garment (upper_body, lower_body, dresses) - kept for backward compatibility.
         garment_metadata: Optional metadata dict with styling instructions (background, style, framing, pose, camera, extras).
         user_attributes: Optional dict of AI-extracted user attributes (body_type, etc.)
+        no_cache: Skip the in-process result cache (debugging / forced regeneration).
         
     Returns:
         dict: {"image_url": "data:...base64,...", "retry_info": [...]} (retry_info may be empty)
@@ -323,18 +1471,100 @@ async def generate_try_on(user_image_files, garment_image_files, category="upper
     # Normalize garments to list if single file
     if not isinstance(garment_image_files, list):
         garment_image_files = [garment_image_files]
-    
-    # Use Gemini 3 Pro for image generation
-    return await _generate_with_gemini(
-        user_image_files,
-        garment_image_files,
-        category,
-        garment_metadata,
-        user_attributes,
-        main_index=main_index,
-        user_quality_flags=user_quality_flags,
+
+    user_image_bytes_list, garment_image_bytes_list = await asyncio.gather(
+        _read_image_bytes_async(user_image_files),
+        _read_image_bytes_async(garment_image_files),
     )
 
+    cache_key = None
+    if not no_cache:
+        cache_key = _try_on_cache_key(
+            user_image_bytes_list,
+            garment_image_bytes_list,
+            category=category,
+            garment_metadata=garment_metadata,
+            user_attributes=user_attributes,
+            main_index=main_index,
+            user_quality_flags=user_quality_flags,
+        )
+        cached = _result_cache_get(cache_key)
+        if cached is not None:
+            logger.info(f"Try-on result cache hit ({cache_key[:12]})")
+            return {**cached, "retry_info": list(cached.get("retry_info", []))}
+
+    # Handed over (not shared) so the generation can drop the raw bytes once they are encoded.
+    pending_images = [user_image_bytes_list, garment_image_bytes_list]
+    del user_image_bytes_list, garment_image_bytes_list
+
+    async def generate_and_cache() -> Dict[str, Any]:
+        user_images, garment_images = pending_images
+        pending_images.clear()
+        # Use Gemini 3 Pro for image generation
+        generation = _generate_with_gemini(
+            user_images,
+            garment_images,
+            category,
+            garment_metadata,
+            user_attributes,
+            main_index=main_index,
+            user_quality_flags=user_quality_flags,
+        )
+        del user_images, garment_images
+        generated = await generation
+        if cache_key is not None and isinstance(generated, dict) and generated.get("image_url"):
+            _result_cache_put(cache_key, generated)
+        return generated
+
+    if cache_key is None:
+        return await generate_and_cache()
+
+    # Coalesce concurrent identical requests: only the first one calls Gemini, the rest await its task.
+    # (No await between the lookup and the insert, so this is race-free on the event loop.)
+    task = _INFLIGHT.get(cache_key)
+    if task is not None:
+        logger.info(f"Joining in-flight try-on generation ({cache_key[:12]})")
+        result = await asyncio.shield(task)
+        return {**result, "retry_info": list(result.get("retry_info", []))}
+
+    task = asyncio.ensure_future(generate_and_cache())
+    _INFLIGHT[cache_key] = task
+    task.add_done_callback(lambda t, key=cache_key: _inflight_done(key, t))
+    # shield: a cancelled caller must not cancel the generation other callers are waiting on.
+    return await asyncio.shield(task)
+
+
+# Optional model verification (disabled by default to avoid an extra network call); read once at import.
+_VERIFY_MODEL = os.getenv("GEMINI_VERIFY_MODEL", "0") == "1"
+# Model names from the first successful listing, kept for the process lifetime.
+_AVAILABLE_MODELS: Optional[List[str]] = None
+_AVAILABLE_MODELS_LOCK = asyncio.Lock()
+
+
+async def _available_models(base_url: str, api_key: str) -> List[str]:
+    """List the API's model names once per process (concurrent first callers share one request)."""
+    global _AVAILABLE_MODELS
+    async with _AVAILABLE_MODELS_LOCK:
+        if _AVAILABLE_MODELS is None:
+            list_response = await get_gemini_client().get(f"{base_url}?key={api_key}", timeout=10.0)
+            if not list_response.is_success:
+                return []
+            list_data = _response_json(list_response)
+            _AVAILABLE_MODELS = [m.get("name", "").split("/")[-1] for m in list_data.get("models", [])]
+            logger.info(f"Available models (sample): {', '.join(_AVAILABLE_MODELS[:20])}")
+        return _AVAILABLE_MODELS
+
+
+def _verified_image_model(model_name: str, available_models: List[str]) -> str:
+    """model_name if it is listed (or nothing was listed), else the first listed Gemini image model."""
+    if available_models and model_name not in available_models:
+        image_models = [m for m in available_models if "gemini" in m.lower() and "image" in m.lower()]
+        logger.warning(f"Model {model_name} not found. Available image models: {image_models}")
+        if image_models:
+            logger.info(f"Trying alternative model: {image_models[0]}")
+            return image_models[0]
+    return model_name
+
 
 async def _generate_with_gemini(user_image_files, garment_image_files, category="upper_body", garment_metadata=None, user_attributes=None, main_index=0, user_quality_flags=None):
     """
@@ -364,11 +1594,7 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
     # Get API key from environment (prefer GEMINI_API_KEY, fallback to GOOGLE_API_KEY)
     api_key = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
     # #region agent log
-    import json as json_lib
-    try:
-        with open('/Users/gerardgrenville/Change Room/.cursor/debug.log', 'a') as f:
-            f.write(json_lib.dumps({"location":"vton.py:63","message":"Checking API key","data":{"hasApiKey":api_key is not None,"apiKeyLength":len(api_key) if api_key else 0},"timestamp":int(__import__('time').time()*1000),"sessionId":"debug-session","runId":"run1","hypothesisId":"A"})+"\n")
-    except: pass
+    _agent_log("vton.py:63", "Checking API key", {"hasApiKey":api_key is not None,"apiKeyLength":len(api_key) if api_key else 0}, "A")
     # #endregion
     if not api_key:
         raise ValueError("GEMINI_API_KEY or GOOGLE_API_KEY environment variable is required")
@@ -376,31 +1602,15 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
     try:
         # Read user image bytes
         # #region agent log
-        try:
-            with open('/Users/gerardgrenville/Change Room/.cursor/debug.log', 'a') as f:
-                f.write(json_lib.dumps({"location":"vton.py:69","message":"Before reading images","data":{"userFilesCount":len(user_image_files),"garmentFilesCount":len(garment_image_files)},"timestamp":int(__import__('time').time()*1000),"sessionId":"debug-session","runId":"run1","hypothesisId":"C"})+"\n")
-        except: pass
+        _agent_log("vton.py:69", "Before reading images", {"userFilesCount":len(user_image_files),"garmentFilesCount":len(garment_image_files)}, "C")
         # #endregion
         
-        user_image_bytes_list = []
-        for user_file in user_image_files:
-            if hasattr(user_file, 'seek'):
-                user_file.seek(0)
-            user_bytes = user_file.read() if hasattr(user_file, 'read') else user_file
-            user_image_bytes_list.append(user_bytes)
+        user_image_bytes_list = _read_image_bytes(user_image_files)
 
         # Read all clothing images into list
-        garment_image_bytes_list = []
-        for garment_file in garment_image_files:
-            if hasattr(garment_file, 'seek'):
-                garment_file.seek(0)
-            garment_bytes = garment_file.read() if hasattr(garment_file, 'read') else garment_file
-            garment_image_bytes_list.append(garment_bytes)
+        garment_image_bytes_list = _read_image_bytes(garment_image_files)
         # #region agent log
-        try:
-            with open('/Users/gerardgrenville/Change Room/.cursor/debug.log', 'a') as f:
-                f.write(json_lib.dumps({"location":"vton.py:80","message":"Clothing images read","data":{"garmentImagesCount":len(garment_image_bytes_list)},"timestamp":int(__import__('time').time()*1000),"sessionId":"debug-session","runId":"run1","hypothesisId":"C"})+"\n")
-        except: pass
+        _agent_log("vton.py:80", "Clothing images read", {"garmentImagesCount":len(garment_image_bytes_list)}, "C")
         # #endregion
         
         # Limit to 5 user images and 5 clothing items (10 total max is safe for Gemini usually, but let's be reasonable)
@@ -414,7 +1624,7 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
         
         # Convert images to base64 for API request
         # Gemini API requires images as base64-encoded inline_data
-        def image_to_base64(image_bytes, *, max_dim: int, jpeg_quality: int):
+        def image_to_base64(image_bytes, *, max_dim: int, jpeg_quality: int, allow_passthrough: bool = True):
             """
             Convert image bytes to base64 string for Gemini API.
             Detects image format and converts to a size-efficient format:
@@ -423,6 +1633,15 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
             """
             try:
                 img = Image.open(io.BytesIO(image_bytes))
+                passthrough_mime = allow_passthrough and _passthrough_image_mime(image_bytes, img, max_dim=max_dim)
+                if passthrough_mime:
+                    # Already a Gemini-native format at an acceptable size: skip decode + re-encode.
+                    return _b64encode_str(image_bytes), passthrough_mime
+                if img.format == "JPEG" and max(img.size) > max_dim:
+                    # Let libjpeg decode at 1/2, 1/4 or 1/8 scale (never below the target size), so the
+                    # LANCZOS pass below only covers the remaining fractional scale.
+                    scale = max_dim / float(max(img.size))
+                    img.draft(None, (math.ceil(img.size[0] * scale), math.ceil(img.size[1] * scale)))
                 img = ImageOps.exif_transpose(img)
 
                 # Downscale large images to keep request payloads reasonable
@@ -441,7 +1660,7 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
                     img.mode == "P" and "transparency" in (img.info or {})
                 )
 
-                buffer = io.BytesIO()
+                buffer = _scratch_buffer()
                 if has_alpha:
                     img.save(buffer, format="PNG", optimize=True)
                     out_mime = "image/png"
@@ -451,10 +1670,10 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
                     )
                     out_mime = "image/jpeg"
 
-                return base64.b64encode(buffer.getvalue()).decode("utf-8"), out_mime
+                return _b64encode_str(buffer.getbuffer()), out_mime
             except Exception as e:
                 logger.warning(f"Could not detect image format, using raw bytes: {e}")
-                return base64.b64encode(image_bytes).decode('utf-8'), 'image/jpeg'
+                return _b64encode_str(image_bytes), 'image/jpeg'
         
         # Model-call payload budget guard:
         # keep the total encoded image bytes under a conservative limit to reduce timeouts/failures.
@@ -463,11 +1682,26 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
         min_main_user_dim = int(os.getenv("VTON_MIN_MAIN_USER_DIM", 1600))
         min_main_user_jpeg_quality = int(os.getenv("VTON_MIN_MAIN_USER_JPEG_QUALITY", 82))
 
-        def estimate_b64_bytes(b64_str: str) -> int:
-            # Base64 chars ≈ 4/3 of bytes. Ignore padding for simplicity.
-            return int(len(b64_str) * 3 / 4)
+        # Encodes by (image, max_dim, quality, passthrough) for this request: the budget loop below
+        # usually shrinks only some references per iteration, so the others are not re-encoded.
+        # Keyed on id() of the input bytes, which limited_user_images/limited_garments keep alive.
+        encode_cache: Dict[Tuple[int, int, int, bool], Tuple[str, str]] = {}
+
+        async def encode_cached(image_bytes, *, max_dim: int, jpeg_quality: int, allow_passthrough: bool):
+            key = (id(image_bytes), max_dim, jpeg_quality, allow_passthrough)
+            encoded = encode_cache.get(key)
+            if encoded is None:
+                encoded = await asyncio.to_thread(
+                    image_to_base64,
+                    image_bytes,
+                    max_dim=max_dim,
+                    jpeg_quality=jpeg_quality,
+                    allow_passthrough=allow_passthrough,
+                )
+                encode_cache[key] = encoded
+            return encoded
 
-        def build_encoded_images(
+        async def build_encoded_images(
             *,
             main_user_dim: int,
             other_user_dim: int,
@@ -477,15 +1711,37 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
             other_garment_dim: int,
             first_garment_q: int,
             other_garment_q: int,
+            allow_passthrough: bool = True,
         ):
-            user_data_local = []
-            for idx, user_bytes in enumerate(limited_user_images):
-                is_main = (idx == int(main_index or 0))
-                user_base64, user_mime = image_to_base64(
+            # PIL decode/resize/encode releases the GIL, so all cache misses are converted in parallel threads.
+            main_idx = int(main_index or 0)
+            user_jobs = [
+                encode_cached(
                     user_bytes,
-                    max_dim=main_user_dim if is_main else other_user_dim,
-                    jpeg_quality=main_user_q if is_main else other_user_q,
+                    max_dim=main_user_dim if idx == main_idx else other_user_dim,
+                    jpeg_quality=main_user_q if idx == main_idx else other_user_q,
+                    allow_passthrough=allow_passthrough,
+                )
+                for idx, user_bytes in enumerate(limited_user_images)
+            ]
+            garment_jobs = [
+                encode_cached(
+                    garment_bytes,
+                    max_dim=first_garment_dim if idx == 0 else other_garment_dim,
+                    jpeg_quality=first_garment_q if idx == 0 else other_garment_q,
+                    allow_passthrough=allow_passthrough,
                 )
+                for idx, garment_bytes in enumerate(limited_garments)
+            ]
+            encoded = await asyncio.gather(*user_jobs, *garment_jobs)
+            user_encoded = encoded[:len(user_jobs)]
+            garment_encoded = encoded[len(user_jobs):]
+
+            # Decoded size, summed while building (base64 chars ≈ 4/3 of bytes; padding ignored).
+            total_bytes = 0
+            user_data_local = []
+            for idx, (user_base64, user_mime) in enumerate(user_encoded):
+                total_bytes += (len(user_base64) * 3) >> 2
                 user_data_local.append(
                     {
                         "base64": user_base64,
@@ -495,12 +1751,8 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
                 )
 
             garment_data_local = []
-            for idx, garment_bytes in enumerate(limited_garments):
-                garment_base64, garment_mime = image_to_base64(
-                    garment_bytes,
-                    max_dim=first_garment_dim if idx == 0 else other_garment_dim,
-                    jpeg_quality=first_garment_q if idx == 0 else other_garment_q,
-                )
+            for idx, (garment_base64, garment_mime) in enumerate(garment_encoded):
+                total_bytes += (len(garment_base64) * 3) >> 2
                 garment_data_local.append(
                     {
                         "base64": garment_base64,
@@ -510,33 +1762,23 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
                         "layer_order": idx,
                     }
                 )
-            total_bytes = sum(estimate_b64_bytes(u["base64"]) for u in user_data_local) + sum(
-                estimate_b64_bytes(g["base64"]) for g in garment_data_local
-            )
             return user_data_local, garment_data_local, total_bytes
 
         # Initial quality/dimension targets
-        main_user_dim = 2200
-        other_user_dim = 1600
-        first_garment_dim = 1800
-        other_garment_dim = 1400
-        main_user_q = 90
-        other_user_q = 82
-        first_garment_q = 86
-        other_garment_q = 80
-
-        # Iteratively shrink until under budget, prioritizing secondary refs.
+        encode_targets: Dict[str, int] = {
+            "main_user_dim": 2200,
+            "other_user_dim": 1600,
+            "first_garment_dim": 1800,
+            "other_garment_dim": 1400,
+            "main_user_q": 90,
+            "other_user_q": 82,
+            "first_garment_q": 86,
+            "other_garment_q": 80,
+        }
+
+        # Shrink until under budget, prioritizing secondary refs (at most max_iters policy steps).
         max_iters = 6
-        user_data, garment_data, total_image_bytes = build_encoded_images(
-            main_user_dim=main_user_dim,
-            other_user_dim=other_user_dim,
-            main_user_q=main_user_q,
-            other_user_q=other_user_q,
-            first_garment_dim=first_garment_dim,
-            other_garment_dim=other_garment_dim,
-            first_garment_q=first_garment_q,
-            other_garment_q=other_garment_q,
-        )
+        user_data, garment_data, total_image_bytes = await build_encoded_images(**encode_targets)
 
         if total_image_bytes > max_total_image_bytes:
             logger.warning(
@@ -544,34 +1786,50 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
                 "Auto-downscaling secondary references."
             )
 
-        for _i in range(max_iters):
-            if total_image_bytes <= max_total_image_bytes:
-                break
-
-            # Priority 1: shrink secondary user refs + accessory garments
-            other_user_dim = max(900, int(other_user_dim * 0.85))
-            other_garment_dim = max(850, int(other_garment_dim * 0.85))
-            other_user_q = max(70, other_user_q - 4)
-            other_garment_q = max(68, other_garment_q - 4)
-
-            # Priority 2: shrink primary garment
-            first_garment_dim = max(1000, int(first_garment_dim * 0.9))
-            first_garment_q = max(72, first_garment_q - 3)
-
-            # Priority 3: as last resort, shrink main user ref slightly
-            main_user_dim = max(min_main_user_dim, int(main_user_dim * 0.92))
-            main_user_q = max(min_main_user_jpeg_quality, main_user_q - 2)
-
-            user_data, garment_data, total_image_bytes = build_encoded_images(
-                main_user_dim=main_user_dim,
-                other_user_dim=other_user_dim,
-                main_user_q=main_user_q,
-                other_user_q=other_user_q,
-                first_garment_dim=first_garment_dim,
-                other_garment_dim=other_garment_dim,
-                first_garment_q=first_garment_q,
-                other_garment_q=other_garment_q,
+            # Jump straight to the first policy step predicted to fit, using the sizes just measured,
+            # instead of re-encoding every intermediate step.
+            main_idx = int(main_index or 0)
+            roles = [
+                ("main_user_dim", "main_user_q") if idx == main_idx else ("other_user_dim", "other_user_q")
+                for idx in range(len(limited_user_images))
+            ] + [
+                ("first_garment_dim", "first_garment_q") if idx == 0 else ("other_garment_dim", "other_garment_q")
+                for idx in range(len(limited_garments))
+            ]
+            measured = [
+                ((len(encoded["base64"]) * 3) >> 2, _image_longest_side(raw), dim_key, q_key)
+                for encoded, raw, (dim_key, q_key) in zip(
+                    user_data + garment_data, [*limited_user_images, *limited_garments], roles
+                )
+            ]
+            measured_at = encode_targets
+            shrink_steps = 0
+            while shrink_steps < max_iters:
+                encode_targets = _shrink_encode_targets(
+                    encode_targets,
+                    min_main_user_dim=min_main_user_dim,
+                    min_main_user_jpeg_quality=min_main_user_jpeg_quality,
+                )
+                shrink_steps += 1
+                predicted = _predict_encoded_bytes(measured, measured_at, encode_targets)
+                if predicted <= max_total_image_bytes * _BUDGET_SOLVER_HEADROOM:
+                    break
+
+            # Shrink passes must re-encode so the lower quality targets actually apply.
+            user_data, garment_data, total_image_bytes = await build_encoded_images(
+                **encode_targets, allow_passthrough=False
             )
+            # The size model is approximate: continue one policy step at a time if it undershot.
+            while total_image_bytes > max_total_image_bytes and shrink_steps < max_iters:
+                encode_targets = _shrink_encode_targets(
+                    encode_targets,
+                    min_main_user_dim=min_main_user_dim,
+                    min_main_user_jpeg_quality=min_main_user_jpeg_quality,
+                )
+                shrink_steps += 1
+                user_data, garment_data, total_image_bytes = await build_encoded_images(
+                    **encode_targets, allow_passthrough=False
+                )
 
         if total_image_bytes > max_total_image_bytes:
             logger.warning(
@@ -581,97 +1839,25 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
         else:
             logger.info(
                 f"VTON payload within budget: {total_image_bytes}B <= {max_total_image_bytes}B "
-                f"(dims user main/other={main_user_dim}/{other_user_dim}, garments first/other={first_garment_dim}/{other_garment_dim})."
+                f"(dims user main/other={encode_targets['main_user_dim']}/{encode_targets['other_user_dim']}, "
+                f"garments first/other={encode_targets['first_garment_dim']}/{encode_targets['other_garment_dim']})."
             )
-        
-        logger.info(f"Generating image with {len(limited_user_images)} user images and {len(limited_garments)} clothing item(s)...")
-        
-        def _sanitize_clothing_description(description):
-            """
-            Sanitize clothing descriptions to avoid triggering content filters while maintaining recognizability.
-            """
-            if not isinstance(description, str):
-                return description
-
-            # Replace potentially problematic terms with safer alternatives
-            replacements = {
-                'lingerie': 'intimate apparel',
-                'lingerie top': 'delicate top',
-                'intimate': 'delicate',
-                'intimates': 'delicates',
-                'bodysuit': 'one-piece outfit',
-                'one-piece': 'one-piece outfit',
-                'one piece': 'one-piece outfit',
-                'unitard': 'one-piece outfit',
-                'leotard': 'one-piece outfit',
-                'catsuit': 'one-piece outfit',
-                'swimsuit': 'swim outfit',
-                'bathing suit': 'swim outfit',
-                'monokini': 'swim outfit',
-                'trikini': 'swim outfit',
-                'bra': 'supportive top',
-                'lacy': 'delicate fabric',
-                'sheer': 'semi-transparent',
-                'transparent': 'semi-transparent',
-                'revealing': 'fitted',
-                'low-cut': 'neckline',
-                'plunging': 'v-neck',
-                'thong': 'minimal undergarment',
-                'bikini': 'swimwear',
-                'micro': 'minimal',
-                'cropped': 'short',
-                'bodycon': 'form-fitting',
-                'skinny': 'fitted',
-                'tight': 'fitted',
-                'cleavage': 'neckline area',
-                'busty': 'full-figured',
-                'sexy': 'stylish',
-                'seductive': 'elegant',
-                'provocative': 'bold',
-                'risque': 'daring',
-                'naughty': 'playful',
-                'slutty': 'fashionable',
-                'trashy': 'casual',
-                'skimpy': 'minimalist',
-                'barely there': 'minimal coverage',
-                'nude': 'neutral tone',
-                'flesh-colored': 'neutral tone',
-                'see-through': 'semi-transparent',
-                'mesh': 'open-weave',
-                'fishnet': 'patterned',
-                'fetish': 'specialty',
-                'bondage': 'restraint-style',
-                'dominatrix': 'bold fashion',
-                'latex': 'shiny material',
-                'leather': 'textured material',
-                'PVC': 'synthetic material',
-                'corset': 'structured top',
-                'bustier': 'fitted bodice',
-                'chemise': 'nightwear',
-                'teddy': 'lingerie set',
-                'camisole': 'light top',
-                'bralette': 'supportive top',
-                'panties': 'undergarments',
-                'thongs': 'minimal undergarments',
-                'boy shorts': 'short underwear',
-                'garter': 'accessory',
-                'stockings': 'hosiery',
-                'pantyhose': 'legwear',
-                'tights': 'leggings',
-                'high heels': 'heels',
-                'stilettos': 'high heels',
-                'platform': 'elevated shoes',
-                'stripper': 'dance wear',
-                'pole dancing': 'fitness wear',
-                'burlesque': 'performance wear',
-            }
 
-            sanitized = description.lower()
-            for old, new in replacements.items():
-                sanitized = sanitized.replace(old.lower(), new)
+        # Only the encoded payload is needed from here on (plus the first garment for the intimate
+        # check): drop the raw bytes and intermediate encodes before the long model call.
+        user_img_count = len(limited_user_images)
+        garment_img_count = len(limited_garments)
+        first_garment_bytes = limited_garments[0] if limited_garments else None
+        del user_image_files, garment_image_files, user_image_bytes_list, garment_image_bytes_list
+        del limited_user_images, limited_garments
+        encode_cache.clear()
 
-            # Capitalize first letter
-            return sanitized.capitalize() if sanitized else description
+        logger.info(f"Generating image with {user_img_count} user images and {garment_img_count} clothing item(s)...")
+        
+        # Sanitized copies of metadata containers by id. Preflight and rewrites build new top-level
+        # dicts but share nested values, so those subtrees are walked once per request. The entry
+        # keeps the original alive, so its id cannot be reused while cached.
+        sanitized_containers: Dict[int, Tuple[Any, Any]] = {}
 
         def _sanitize_metadata_value(value):
             """
@@ -680,106 +1866,73 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
             """
             if isinstance(value, str):
                 return _sanitize_clothing_description(value)
+            if not isinstance(value, (list, dict)):
+                return value
+            cached = sanitized_containers.get(id(value))
+            if cached is not None and cached[0] is value:
+                return cached[1]
             if isinstance(value, list):
-                return [_sanitize_metadata_value(v) for v in value]
-            if isinstance(value, dict):
-                return {k: _sanitize_metadata_value(v) for k, v in value.items()}
-            return value
+                sanitized = [_sanitize_metadata_value(v) for v in value]
+            else:
+                sanitized = {k: _sanitize_metadata_value(v) for k, v in value.items()}
+            sanitized_containers[id(value)] = (value, sanitized)
+            return sanitized
 
         # Build text prompt for Gemini 3 Pro Image
-        user_img_count = len(limited_user_images)
-        garment_img_count = len(limited_garments)
         user_refs = "image" if user_img_count == 1 else f"first {user_img_count} images"
 
+        # Quality notes and user attributes are fixed for the request: build that fragment once.
+        user_reference_prompt = _user_reference_prompt(user_attributes, user_quality_flags)
+
+        # Retries rebuild the prompt from metadata that is often unchanged; the prompt only depends on
+        # the metadata content here (everything else is fixed for this request), so memoize on it.
+        base_prompt_cache: Dict[bytes, Tuple[str, Dict[str, Any]]] = {}
+        # Identity fast path: metadata dicts are replaced (never mutated in place) by the preflight and
+        # rewrite steps, so the same object means the same content and skips the canonical-JSON key.
+        last_base_prompt: List[Any] = [None, None]  # [metadata object, (prompt, sanitized_metadata)]
+
         def build_base_text_prompt(meta_for_prompt: Optional[Dict[str, Any]]) -> Tuple[str, Dict[str, Any]]:
             """
             Build the full base prompt (including metadata section) from the current metadata state.
             Returns (prompt, sanitized_metadata_used).
             """
+            if meta_for_prompt is not None and meta_for_prompt is last_base_prompt[0]:
+                return last_base_prompt[1]
+            cache_key = _canonical_json_bytes(meta_for_prompt) if isinstance(meta_for_prompt, dict) else b""
+            cached = base_prompt_cache.get(cache_key)
+            if cached is None:
+                cached = build_base_text_prompt_uncached(meta_for_prompt)
+                base_prompt_cache[cache_key] = cached
+            last_base_prompt[0], last_base_prompt[1] = meta_for_prompt, cached
+            return cached
+
+        def build_base_text_prompt_uncached(meta_for_prompt: Optional[Dict[str, Any]]) -> Tuple[str, Dict[str, Any]]:
             local_meta: Dict[str, Any] = {}
             if isinstance(meta_for_prompt, dict):
                 local_meta = _sanitize_metadata_value(meta_for_prompt)  # type: ignore
 
-            text_prompt = (
-                "You are a fashion virtual try-on engine. "
-                f"Use the {user_refs} as the person reference. These images define the person's identity (face, hair, eyes), body shape, stature/height impression, and overall appearance. "
+            # Static rules first, request-specific text after: keeps the prompt prefix byte-identical
+            # across requests so Gemini's implicit prefix caching can reuse it.
+            buf: List[str] = [_TRY_ON_STATIC_PREAMBLE]
+            buf.append(
+                f"IMAGE ROLES: Use the {user_refs} as the person reference. These images define the person's identity (face, hair, eyes), body shape, stature/height impression, and overall appearance. "
                 f"The FIRST user image (index {main_index + 1}) is the Main Reference Image for preserving any non-conflicting garments. "
-                f"Use the subsequent {garment_img_count} images as new garments that must be worn by that same person. "
-                "Generate one photorealistic image of the person wearing all provided NEW clothing items. "
-                "OUTFIT PRESERVATION: For any clothing or accessories NOT provided in the new garments list, faithfully reproduce them from the Main Reference Image. "
-                "Replace ONLY the garments that conflict with the new items (e.g., new top replaces the old top, but keep the original pants/shoes if not replaced; a dress replaces both top and bottom). "
-                "BACKGROUND & POSE: Do NOT reuse the original background. Use a clean, neutral, flattering background. Do NOT lock the exact pose/angle—allow natural variation that still fits the person. "
-                "IDENTITY FIDELITY: All user images must be used to perfectly maintain the same face, hair, eyes, skin tone, and body shape/height impression in the final image. "
-                "Every user-specified wearing style or positioning instruction is mandatory and overrides any defaults. "
-                "Do not ignore, soften, or reinterpret those directives under any circumstance.\n\n"
+                f"Use the subsequent {garment_img_count} images as new garments that must be worn by that same person.\n\n"
             )
+            buf.append(user_reference_prompt)
 
-            if user_quality_flags:
-                low_res_count = sum(1 for f in user_quality_flags if f.get("low_res"))
-                if low_res_count > 0:
-                    text_prompt += (
-                        f"NOTE: Some user photos are lower resolution ({low_res_count}). "
-                        "Prioritize the sharpest, best-lit reference when ensuring identity fidelity.\n"
-                    )
-
-            # Inject extracted user attributes to reinforce identity
-            if user_attributes:
-                text_prompt += "\nPHYSICAL ATTRIBUTES (Reinforce these features found in the user images):\n"
-                if user_attributes.get('body_type'):
-                    text_prompt += f"- Body Type: {user_attributes['body_type']}\n"
-                if user_attributes.get('skin_tone'):
-                    text_prompt += f"- Skin Tone: {user_attributes['skin_tone']}\n"
-                if user_attributes.get('hair_color'):
-                    text_prompt += f"- Hair: {user_attributes['hair_color']}\n"
-                if user_attributes.get('gender'):
-                    text_prompt += f"- Gender Presentation: {user_attributes['gender']}\n"
-                if user_attributes.get('age_range'):
-                    text_prompt += f"- Age Group: {user_attributes['age_range']}\n"
-                text_prompt += "Ensure the generated person strictly adheres to these physical characteristics to maintain identity consistency.\n\n"
-
-            text_prompt += (
-                "IMPORTANT SAFETY GUIDELINES: "
-                "Generate appropriate, tasteful fashion content only. "
-                "If any clothing appears potentially inappropriate, automatically modify it to be more modest and professional while maintaining the essential style and functionality. "
-                "Ensure all generated content complies with general audience standards. "
-                "Add subtle coverage or opacity as needed to maintain appropriateness without changing the garment's fundamental design."
-            )
+            buf.append(_TRY_ON_SAFETY_GUIDELINES)
 
             # If this request is flagged as intimate/high-risk, enforce a deterministic “modesty contract”
             # so the image model can comply without hard blocking. We allow underlayers/coverage.
-            if local_meta.get("modesty_contract") is True or local_meta.get("intimate_mode") is True:
-                text_prompt += (
-                    "\n\nMODESTY CONTRACT (MANDATORY): "
-                    "This outfit may include intimate or minimal-coverage garments. "
-                    "You MUST output a general-audience, tasteful fashion image. "
-                    "If any garment is small, sheer, or revealing, automatically add opaque lining, increase coverage, "
-                    "and/or add a simple underlayer (e.g., camisole, bralette lining, slip, bandeau, mesh base) "
-                    "while keeping the garment recognizable. "
-                    "Use conservative studio styling, avoid close-ups, avoid explicit emphasis, and keep pose neutral."
-                )
+            meta_get = local_meta.get
+            if meta_get("modesty_contract") is True or meta_get("intimate_mode") is True:
+                buf.append(_TRY_ON_MODESTY_CONTRACT)
 
             # Add wearing style instructions if provided
             if local_meta:
-                def _normalize_instruction(value):
-                    if isinstance(value, str):
-                        cleaned = value.strip()
-                        if cleaned:
-                            return cleaned
-                    return None
-
-                def _extract_descriptor(item_info, fallback_index):
-                    descriptor = (
-                        item_info.get('descriptor')
-                        or item_info.get('item_type')
-                        or item_info.get('category')
-                        or f"item {fallback_index + 1}"
-                    )
-                    if isinstance(descriptor, str):
-                        descriptor = descriptor.strip()
-                    return descriptor or f"item {fallback_index + 1}"
-
-                wearing_instructions = local_meta.get('wearing_instructions')
-                items_wearing_styles = local_meta.get('items_wearing_styles')
+                wearing_instructions = meta_get('wearing_instructions')
+                items_wearing_styles = meta_get('items_wearing_styles')
 
                 normalized_instructions = []
                 if isinstance(wearing_instructions, list):
@@ -797,12 +1950,12 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
                         normalized_instructions.append(sanitized)
 
                 if normalized_instructions:
-                    text_prompt += "\n\nMANDATORY wearing directives (never override these):\n"
+                    buf.append("\n\nMANDATORY wearing directives (never override these):\n")
                     for instruction in normalized_instructions:
-                        text_prompt += f"- {instruction}\n"
+                        buf.append(f"- {instruction}\n")
 
                 if items_wearing_styles and isinstance(items_wearing_styles, list) and len(items_wearing_styles) > 0:
-                    text_prompt += "\n\nPer-item wearing instructions (non-negotiable):\n"
+                    buf.append("\n\nPer-item wearing instructions (non-negotiable):\n")
                     for idx, item_info in enumerate(items_wearing_styles):
                         if not isinstance(item_info, dict):
                             logger.warning(f"Ignoring invalid item_wearing_styles entry at index {idx}: {item_info!r}")
@@ -824,103 +1977,91 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
                         safe_descriptor = _sanitize_clothing_description(descriptor)
                         safe_style_desc = _sanitize_clothing_description(style_desc)
                         image_reference = user_img_count + item_index + 1
-                        text_prompt += (
+                        buf.append(
                             f"- Image {image_reference}: Render the {safe_descriptor} {safe_style_desc}. "
                             "This positioning is mandatory.\n"
                         )
 
-                if local_meta.get('strict_wearing_enforcement'):
-                    text_prompt += (
+                if meta_get('strict_wearing_enforcement'):
+                    buf.append(
                         "\n\nSTRICT COMPLIANCE: Adjust garment fit, tuck, tilt, or orientation until every "
                         "wearing instruction is satisfied exactly. Never revert to default placements."
                     )
-                if local_meta.get('wearing_instruction_policy'):
-                    policy = local_meta.get('wearing_instruction_policy')
-                    text_prompt += f"\n\nWearing instruction policy: {policy}."
-                if local_meta.get('wearing_instruction_summary'):
-                    summary = local_meta.get('wearing_instruction_summary')
-                    text_prompt += f"\n\nSummary of required styling outcomes: {summary}"
-
-                other_metadata = {
-                    k: v for k, v in local_meta.items()
-                    if k not in [
-                        'wearing_instructions',
-                        'items_wearing_styles',
-                        'strict_wearing_enforcement',
-                        'wearing_instruction_policy',
-                        'wearing_instruction_summary',
-                        'enforced_items_count'
-                    ]
-                }
+                policy = meta_get('wearing_instruction_policy')
+                if policy:
+                    buf.append(f"\n\nWearing instruction policy: {policy}.")
+                summary = meta_get('wearing_instruction_summary')
+                if summary:
+                    buf.append(f"\n\nSummary of required styling outcomes: {summary}")
+
+                # Built once per distinct metadata (build_base_text_prompt is memoized on its content);
+                # skip the filtering copy entirely when no wearing keys are present.
+                if _WEARING_METADATA_KEYS.isdisjoint(local_meta):
+                    other_metadata = local_meta
+                else:
+                    other_metadata = {k: v for k, v in local_meta.items() if k not in _WEARING_METADATA_KEYS}
                 if other_metadata:
-                    metadata_str = json.dumps(other_metadata, indent=2, ensure_ascii=False)
-                    text_prompt += f"\n\nAdditional styling instructions:\n{metadata_str}"
-
-            text_prompt += (
-                "\n\nCONTENT FILTER AVOIDANCE: "
-                "If this request involves any clothing that could be considered revealing or intimate, "
-                "automatically add subtle opacity, coverage, or conservative styling to ensure the generated image "
-                "meets general audience standards while preserving the garment's essential design and functionality. "
-                "Make tasteful modifications as needed without changing the fundamental garment type or purpose."
-            )
+                    metadata_str = _dumps_text(other_metadata, indent=True)
+                    buf.append(f"\n\nAdditional styling instructions:\n{metadata_str}")
 
+            buf.append(_TRY_ON_CONTENT_FILTER_SUFFIX)
+
+            text_prompt = "".join(buf)
             return text_prompt, local_meta
 
-        def build_parts(text_prompt_value: str):
-            """Construct request parts with a given text prompt."""
-            parts_local = [
-                {
-                    "text": text_prompt_value
+        # Image parts never change between attempts; only the text prompt does, so build them once.
+        image_parts = [
+            {
+                "inline_data": {
+                    "mime_type": item['mimeType'],
+                    "data": item['base64'],
                 }
-            ]
-            for item in user_data:
-                parts_local.append({
-                    "inline_data": {
-                        "mime_type": item['mimeType'],
-                        "data": item['base64'],
-                    }
-                })
-            for item in garment_data:
-                parts_local.append({
-                    "inline_data": {
-                        "mime_type": item['mimeType'],
-                        "data": item['base64'],
+            }
+            for item in (*user_data, *garment_data)
+        ]
+
+        def build_payload(text_prompt_value: str) -> Dict[str, Any]:
+            """Construct the generation request payload with a given text prompt."""
+            return {
+                "contents": [
+                    {
+                        "role": "user",
+                        "parts": [{"text": text_prompt_value}, *image_parts],
                     }
-                })
-            return parts_local
+                ],
+                "generationConfig": _TRY_ON_GENERATION_CONFIG,
+                "safetySettings": _TRY_ON_SAFETY_SETTINGS,
+            }
+
+        # Serialize the image parts once; each attempt only encodes its prompt text into the body.
+        payload_template = _TextPayloadTemplate(build_payload)
 
         # Use Gemini 3 Pro Image for virtual try-on
         logger.info(f"🚀 Starting virtual try-on generation with Gemini 3 Pro Image")
-        logger.info(f"   Person images: {len(limited_user_images)}")
-        logger.info(f"   Clothing items: {len(limited_garments)}")
+        logger.info(f"   Person images: {user_img_count}")
+        logger.info(f"   Clothing items: {garment_img_count}")
         
         base_url = "https://generativelanguage.googleapis.com/v1beta/models"
         model_name = "gemini-3-pro-image-preview"
         
-        # Optional: verify the model is available (disabled by default to avoid extra network call)
-        if os.getenv("GEMINI_VERIFY_MODEL", "0") == "1":
-            try:
-                list_endpoint = f"{base_url}?key={api_key}"
-                async with httpx.AsyncClient(timeout=10.0) as list_client:
-                    list_response = await list_client.get(list_endpoint)
-                    if list_response.is_success:
-                        list_data = list_response.json()
-                        available_models = [m.get("name", "").split("/")[-1] for m in list_data.get("models", [])]
-                        logger.info(f"Available models (sample): {', '.join(available_models[:20])}")
-                        if model_name not in available_models:
-                            image_models = [m for m in available_models if "gemini" in m.lower() and "image" in m.lower()]
-                            logger.warning(f"Model {model_name} not found. Available image models: {image_models}")
-                            if image_models:
-                                model_name = image_models[0]
-                                logger.info(f"Trying alternative model: {model_name}")
-            except Exception as e:
-                logger.warning(f"Could not verify model availability: {e}")
+        # Optional: verify the model is available. The listing is cached for the process lifetime; until
+        # then it runs alongside the first attempt and is only consulted if the model returns 404.
+        model_check: Optional["asyncio.Future[List[str]]"] = None
+        if _VERIFY_MODEL:
+            if _AVAILABLE_MODELS is not None:
+                model_name = _verified_image_model(model_name, _AVAILABLE_MODELS)
+            else:
+                model_check = asyncio.ensure_future(_available_models(base_url, api_key))
+                # Mark a failed listing as retrieved when nobody ends up awaiting it.
+                model_check.add_done_callback(lambda t: t.cancelled() or t.exception())
         
         max_attempts = 4
         last_failure_details: Dict[str, Any] = {}
         retry_info: List[Dict[str, Any]] = []
 
-        current_metadata: Dict[str, Any] = copy.deepcopy(garment_metadata) if isinstance(garment_metadata, dict) else {}
+        # No clone: nothing below mutates metadata in place. The modesty contract takes a copy, and the
+        # heuristic/Gemini rewrites return new dicts, so the caller's dict is never touched.
+        current_metadata: Dict[str, Any] = garment_metadata if isinstance(garment_metadata, dict) else {}
 
         def is_intimate_request(meta: Dict[str, Any], cat: str) -> bool:
             # Category hint (best-effort; frontend may send upper_body even for bra/bikini)
@@ -928,41 +2069,9 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
             if cat_l in ("intimates", "lingerie", "swimwear", "bikini"):
                 return True
 
-            # Metadata hints
-            try:
-                scan_text = json.dumps(meta or {}, ensure_ascii=False).lower()
-            except Exception:
-                scan_text = str(meta or "").lower()
-
-            if any(k in scan_text for k in INTIMATE_KEYWORDS):
-                return True
-
-            # Additional common hints
-            for k in ("subcategory", "item_type", "category", "body_region", "tags"):
-                v = meta.get(k) if isinstance(meta, dict) else None
-                if isinstance(v, str) and any(w in v.lower() for w in INTIMATE_KEYWORDS):
-                    return True
-                if isinstance(v, list) and any(isinstance(x, str) and any(w in x.lower() for w in INTIMATE_KEYWORDS) for x in v):
-                    return True
-
-            # Per-item wearing metadata (if present) can contain good descriptors even when top-level description is neutral.
-            try:
-                items = meta.get("items_wearing_styles") if isinstance(meta, dict) else None
-                if isinstance(items, list):
-                    for item in items:
-                        if not isinstance(item, dict):
-                            continue
-                        for k in ("descriptor", "item_type", "category", "subcategory", "body_region", "wearing_style", "prompt_text"):
-                            v = item.get(k)
-                            if isinstance(v, str) and any(w in v.lower() for w in INTIMATE_KEYWORDS):
-                                return True
-                        tags = item.get("tags")
-                        if isinstance(tags, list) and any(isinstance(t, str) and any(w in t.lower() for w in INTIMATE_KEYWORDS) for t in tags):
-                            return True
-            except Exception:
-                pass
-
-            return False
+            # Metadata hints: any key or string value, including per-item wearing metadata and tags,
+            # which can carry good descriptors even when the top-level description is neutral.
+            return _contains_intimate_keyword(meta)
 
         async def detect_intimate_from_gemini_vision(
             client: httpx.AsyncClient,
@@ -977,23 +2086,12 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
             if os.getenv("GEMINI_INTIMATE_DETECT_ENABLED", "1") != "1":
                 return False, "disabled"
 
-            # Keep this lightweight: downscale + compress to reduce request size.
-            try:
-                img = Image.open(io.BytesIO(garment_bytes))
-                img = ImageOps.exif_transpose(img)
-                w, h = img.size
-                max_dim = int(os.getenv("GEMINI_INTIMATE_DETECT_MAX_DIM", "900"))
-                longest = max(w, h)
-                if longest > max_dim:
-                    scale = max_dim / float(longest)
-                    img = img.resize((max(1, int(w * scale)), max(1, int(h * scale))), Image.Resampling.LANCZOS)
-                buf = io.BytesIO()
-                img.convert("RGB").save(buf, format="JPEG", quality=70, optimize=True, progressive=True)
-                b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
-                mime = "image/jpeg"
-            except Exception:
-                b64 = base64.b64encode(garment_bytes).decode("utf-8")
-                mime = "image/jpeg"
+            # Decode/resize/encode runs in a worker thread so other requests keep the event loop.
+            b64, mime = await asyncio.to_thread(
+                _prepare_intimate_detect_image,
+                garment_bytes,
+                max_dim=int(os.getenv("GEMINI_INTIMATE_DETECT_MAX_DIM", "900")),
+            )
 
             model = os.getenv("GEMINI_INTIMATE_DETECT_MODEL", "gemini-1.5-flash")
             endpoint = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
@@ -1030,7 +2128,7 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
             if not resp.is_success:
                 return False, f"http_error:{resp.status_code}"
 
-            data = resp.json()
+            data = _response_json(resp)
             candidates = (data or {}).get("candidates") or []
             if not candidates:
                 return False, "no_candidates"
@@ -1043,16 +2141,18 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
             if not text_out:
                 return False, "empty_text"
             if text_out.startswith("```"):
-                text_out = re.sub(r"^```[a-zA-Z0-9_-]*\s*", "", text_out).strip()
-                text_out = re.sub(r"\s*```$", "", text_out).strip()
-            parsed = json.loads(text_out)
+                text_out = _CODE_FENCE_RE.sub("", text_out).strip()
+            if not text_out.startswith("{"):
+                return False, "non_object_json"
+            parsed = _loads_json(text_out)
             is_int = bool(parsed.get("is_intimate"))
             label = str(parsed.get("label") or "")
             reason = str(parsed.get("reason") or "")
             return is_int, f"{label}:{reason}"[:140]
 
         def apply_modesty_contract(meta: Dict[str, Any]) -> Dict[str, Any]:
-            out = copy.deepcopy(meta) if isinstance(meta, dict) else {}
+            # Only top-level keys are set below, so a shallow copy keeps the input untouched.
+            out = dict(meta) if isinstance(meta, dict) else {}
             out["modesty_contract"] = True
             out["intimate_mode"] = True
             # Bias towards safe framing; do not force full_body for intimate items.
@@ -1104,443 +2204,320 @@ async def _generate_with_gemini(user_image_files, garment_image_files, category=
             # Note: prompt will be rebuilt after this.
             pass
 
-        def summarize_candidate(candidate_obj):
-            finish_reason_local = candidate_obj.get("finishReason") or candidate_obj.get("finish_reason")
-            safety_ratings = candidate_obj.get("safetyRatings") or []
-            content_obj = candidate_obj.get("content", {}) or {}
-            parts_local = content_obj.get("parts", []) or []
-            texts = [str(p.get("text", "")) for p in parts_local if isinstance(p, dict) and "text" in p and p.get("text")]
-            return finish_reason_local, safety_ratings, parts_local, texts
-
-        async with httpx.AsyncClient(timeout=300.0) as client:  # 5 minute timeout for image generation
-            # If not detected by metadata, do a lightweight Gemini vision check on the first garment image.
-            if not intimate_flag and limited_garments:
-                try:
-                    is_int, label = await asyncio.wait_for(
-                        detect_intimate_from_gemini_vision(
-                            client,
-                            api_key_value=api_key,
-                            garment_bytes=limited_garments[0],
-                        ),
-                        timeout=float(os.getenv("GEMINI_INTIMATE_DETECT_TIMEOUT_S", "6")),
-                    )
-                    if is_int:
-                        intimate_flag = True
-                        retry_info.append({
-                            "attempt": 1,
-                            "strategy": "intimate_vision_detect",
-                            "reason": "gemini_vision",
-                            "modificationsSummary": label or "Detected intimate item via Gemini vision.",
-                        })
-                except Exception:
-                    pass
-
-            if intimate_flag and not modesty_applied:
-                await apply_intimate_pipeline("intimate_detected")
+        # Shared pooled client: connections (TCP + TLS) are reused across attempts and requests.
+        client = get_gemini_client()
+        # If not detected by metadata, do a lightweight Gemini vision check on the first garment image.
+        if (
+            not intimate_flag
+            and first_garment_bytes is not None
+            and (category or "").lower() not in _NON_INTIMATE_CATEGORIES
+        ):
+            try:
+                is_int, label = await asyncio.wait_for(
+                    detect_intimate_from_gemini_vision(
+                        client,
+                        api_key_value=api_key,
+                        garment_bytes=first_garment_bytes,
+                    ),
+                    timeout=float(os.getenv("GEMINI_INTIMATE_DETECT_TIMEOUT_S", "6")),
+                )
+                if is_int:
+                    intimate_flag = True
+                    retry_info.append({
+                        "attempt": 1,
+                        "strategy": "intimate_vision_detect",
+                        "reason": "gemini_vision",
+                        "modificationsSummary": label or "Detected intimate item via Gemini vision.",
+                    })
+            except Exception:
+                pass
 
-            # Build prompt after all preflight modifications (metadata/vision detection).
-            base_prompt, _ = build_base_text_prompt(current_metadata)
-            current_prompt: str = base_prompt
+        if intimate_flag and not modesty_applied:
+            await apply_intimate_pipeline("intimate_detected")
 
-            for attempt in range(1, max_attempts + 1):
-                retry_suffix = ""
-                if attempt == 2:
-                    retry_suffix = "\n\nRETRY: Keep output professional, conservative, and general-audience."
-                elif attempt == 3:
-                    retry_suffix = "\n\nRETRY: Increase coverage and opacity; avoid close-ups; professional studio framing."
-                elif attempt == 4:
-                    retry_suffix = "\n\nRETRY (MAX SAFETY): Default to conservative studio portrait; fully opaque fabrics; layered styling."
+        # Build prompt after all preflight modifications (metadata/vision detection).
+        base_prompt, _ = build_base_text_prompt(current_metadata)
+        current_prompt: str = base_prompt
 
-                text_prompt = current_prompt + retry_suffix
-                parts = build_parts(text_prompt)
+        # Speculative retry: send the baseline and the (deterministic) heuristic rewrite together so a
+        # first-attempt rejection costs max(attempt 1, attempt 2) latency instead of their sum.
+        speculative_retry = os.getenv("GEMINI_SPECULATIVE_RETRY", "0") == "1" and max_attempts >= 2
+        # Opt-in: the first Gemini rewrite also asks for the later planned strictness levels in the same
+        # call, so escalating after another rejection needs no extra round trip.
+        batch_rewrites = os.getenv("GEMINI_REWRITE_BATCH", "0") == "1"
+        prefetched_rewrites: Dict[str, Tuple[Dict[str, Any], str, str]] = {}
 
-                logger.info(f"Attempt {attempt}/{max_attempts} - calling Gemini 3 Pro Image: {model_name}")
+        async def apply_rewrite(attempt: int, *, reason: str = "content_rejection", heuristic_only: bool = False) -> None:
+            """
+            Rewrite current_metadata/current_prompt after a rejected attempt, following _REWRITE_PLAN.
+            Gemini rewrites get a heuristic sanitization layer and fall back to heuristic-only on error.
+            """
+            nonlocal current_metadata, current_prompt
+            strategy, strictness = ("heuristic", "moderate") if heuristic_only else _REWRITE_PLAN[attempt]
+            if strategy == "gemini":
                 try:
-                    endpoint = f"{base_url}/{model_name}:generateContent"
-                    payload = {
-                        "contents": [
-                            {
-                                "role": "user",
-                                "parts": parts,
-                            }
-                        ],
-                        "generationConfig": {
-                            "responseModalities": ["TEXT", "IMAGE"],
-                        },
-                        "safetySettings": [
-                            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_LOW_AND_ABOVE"},
-                            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-                        ],
-                    }
-                    response = await _gemini_post_json(
+                    prefetched = prefetched_rewrites.pop(strictness, None)
+                    # Later rewrites that can still run (the last attempt is never rewritten).
+                    later = [
+                        level for planned, (kind, level) in sorted(_REWRITE_PLAN.items())
+                        if attempt < planned < max_attempts and kind == "gemini" and level != strictness
+                    ] if batch_rewrites and prefetched is None else []
+                    if prefetched is not None:
+                        new_meta, additions, gem_summary = prefetched
+                    elif later:
+                        batch = await rewrite_for_modesty_gemini_batch(
+                            client,
+                            api_key=api_key,
+                            jobs=[
+                                {
+                                    "metadata": current_metadata,
+                                    "prompt": current_prompt,
+                                    "last_failure": last_failure_details,
+                                    "strictness": level,
+                                }
+                                for level in (strictness, *later)
+                            ],
+                        )
+                        if batch[0] is None:
+                            raise RuntimeError("gemini_rewrite_batch_unusable_entry")
+                        for level, result in zip(later, batch[1:]):
+                            if result is not None:
+                                prefetched_rewrites[level] = result
+                        new_meta, additions, gem_summary = batch[0]
+                    else:
+                        new_meta, additions, gem_summary = await rewrite_for_modesty_gemini(
+                            client,
+                            api_key=api_key,
+                            metadata=current_metadata,
+                            prompt=current_prompt,
+                            last_failure=last_failure_details,
+                            strictness=strictness,
+                        )
+                    sanitized_meta, safe_additions, heur_summary = rewrite_for_modesty_heuristic(
+                        new_meta,
+                        additions,
+                        strictness=strictness,
+                    )
+                    current_metadata = sanitized_meta
+                    rebuilt, _ = build_base_text_prompt(current_metadata)
+                    current_prompt = rebuilt + "\n\n" + safe_additions
+                    retry_info.append({
+                        "attempt": attempt + 1,
+                        "strategy": "gemini_rewrite",
+                        "reason": reason,
+                        "modificationsSummary": f"{gem_summary};{heur_summary}",
+                    })
+                except Exception as e:
+                    # Fall back to heuristic-only if Gemini rewrite fails.
+                    safe_meta, safe_prompt, summary = rewrite_for_modesty_heuristic(
+                        current_metadata,
+                        current_prompt,
+                        strictness=strictness,
+                    )
+                    current_metadata = safe_meta
+                    current_prompt = safe_prompt
+                    retry_info.append({
+                        "attempt": attempt + 1,
+                        "strategy": "heuristic",
+                        "reason": "gemini_rewrite_failed_fallback",
+                        "modificationsSummary": f"{summary};err={str(e)[:120]}",
+                    })
+                return
+
+            safe_meta, safe_prompt, summary = rewrite_for_modesty_heuristic(
+                current_metadata,
+                build_base_text_prompt(current_metadata)[0],
+                strictness=strictness,
+            )
+            current_metadata = safe_meta
+            current_prompt = safe_prompt
+            retry_info.append({
+                "attempt": attempt + 1,
+                "strategy": "heuristic",
+                "reason": reason,
+                "modificationsSummary": summary,
+            })
+
+        endpoint = f"{base_url}/{model_name}:generateContent"
+        url = f"{endpoint}?key={api_key}"
+        attempt = 0
+        while attempt < max_attempts:
+            attempt += 1
+            text_prompt = current_prompt + _TRY_ON_RETRY_SUFFIXES.get(attempt, "")
+            # One timestamp shared by this attempt's agent-log records (none when the log is off).
+            ts_ms = _time_ns() // 1_000_000 if _AGENT_LOG_ENABLED else None
+            pending_logs: List[str] = []
+
+            try:
+                payload = payload_template.render(text_prompt)
+                if speculative_retry and attempt == 1:
+                    logger.info("Attempts 1-2/%d - calling Gemini 3 Pro Image with a speculative rewrite: %s", max_attempts, model_name)
+                    spec_meta, spec_prompt, spec_summary = rewrite_for_modesty_heuristic(
+                        current_metadata,
+                        current_prompt,
+                        strictness="moderate",
+                    )
+                    # If both calls fail, the retry path continues from the rewritten attempt 2.
+                    attempt = 2
+                    current_metadata = spec_meta
+                    current_prompt = spec_prompt
+                    retry_info.append({
+                        "attempt": 2,
+                        "strategy": "heuristic",
+                        "reason": "speculative",
+                        "modificationsSummary": spec_summary,
+                    })
+                    winner, image_url, failure = await _first_successful_attempt([
+                        (1, _call_gemini_once(client, url=url, payload=payload, attempt=1)),
+                        (2, _call_gemini_once(
+                            client,
+                            url=url,
+                            payload=payload_template.render(spec_prompt + _TRY_ON_RETRY_SUFFIXES[2]),
+                            attempt=2,
+                        )),
+                    ])
+                    if winner == 1:
+                        attempt = 1
+                        retry_info.pop()
+                else:
+                    logger.info("Attempt %d/%d - calling Gemini 3 Pro Image: %s", attempt, max_attempts, model_name)
+                    image_url, failure = await _call_gemini_once(
                         client,
-                        url=f"{endpoint}?key={api_key}",
-                        headers={"Content-Type": "application/json"},
+                        url=url,
                         payload=payload,
+                        attempt=attempt,
                     )
-                    
-                    if not response.is_success:
-                        error_text = response.text
-                        # #region agent log
-                        try:
-                            with open('/Users/gerardgrenville/Change Room/.cursor/debug.log', 'a') as f:
-                                f.write(json_lib.dumps({"location":"vton.py:326","message":"Gemini API request failed","data":{"statusCode":response.status_code,"errorText":error_text[:500],"attempt":attempt},"timestamp":int(__import__('time').time()*1000),"sessionId":"debug-session","runId":"run1","hypothesisId":"E"})+"\n")
-                        except: pass
-                        # #endregion
-                        logger.error(f"Gemini 3 Pro Image failed (attempt {attempt}): {response.status_code} - {error_text}")
-                        last_failure_details = {
-                            "reason": "http_error",
-                            "status": response.status_code,
-                            "error": error_text[:800],
-                            "attempt": attempt,
-                        }
-
-                        should_rewrite = is_content_rejection(
-                            http_status=response.status_code,
-                            error_text=error_text,
-                        )
-                        if should_rewrite and attempt < max_attempts:
-                            if attempt == 1:
-                                # Heuristic rewrite (first failure)
-                                safe_meta, safe_prompt, summary = rewrite_for_modesty_heuristic(
-                                    current_metadata,
-                                    build_base_text_prompt(current_metadata)[0],
-                                    strictness="moderate",
-                                )
-                                current_metadata = safe_meta
-                                current_prompt = safe_prompt
-                                retry_info.append({
-                                    "attempt": attempt + 1,
-                                    "strategy": "heuristic",
-                                    "reason": "content_rejection",
-                                    "modificationsSummary": summary,
-                                })
-                            elif attempt == 2:
-                                # Gemini text-only rewrite (second failure) with heuristic sanitization layer.
-                                try:
-                                    new_meta, additions, gem_summary = await rewrite_for_modesty_gemini(
-                                        client,
-                                        api_key=api_key,
-                                        metadata=current_metadata,
-                                        prompt=current_prompt,
-                                        last_failure=last_failure_details,
-                                        strictness="moderate",
-                                    )
-                                    sanitized_meta, safe_additions, heur_summary = rewrite_for_modesty_heuristic(
-                                        new_meta,
-                                        additions,
-                                        strictness="moderate",
-                                    )
-                                    current_metadata = sanitized_meta
-                                    rebuilt, _ = build_base_text_prompt(current_metadata)
-                                    current_prompt = rebuilt + "\n\n" + safe_additions
-                                    retry_info.append({
-                                        "attempt": attempt + 1,
-                                        "strategy": "gemini_rewrite",
-                                        "reason": "content_rejection",
-                                        "modificationsSummary": f"{gem_summary};{heur_summary}",
-                                    })
-                                except Exception as e:
-                                    # Fall back to heuristic-only if Gemini rewrite fails.
-                                    safe_meta, safe_prompt, summary = rewrite_for_modesty_heuristic(
-                                        current_metadata,
-                                        current_prompt,
-                                        strictness="moderate",
-                                    )
-                                    current_metadata = safe_meta
-                                    current_prompt = safe_prompt
-                                    retry_info.append({
-                                        "attempt": attempt + 1,
-                                        "strategy": "heuristic",
-                                        "reason": "gemini_rewrite_failed_fallback",
-                                        "modificationsSummary": f"{summary};err={str(e)[:120]}",
-                                    })
-                            elif attempt == 3:
-                                # Gemini text-only rewrite (third failure) with heuristic sanitization layer.
-                                try:
-                                    new_meta, additions, gem_summary = await rewrite_for_modesty_gemini(
-                                        client,
-                                        api_key=api_key,
-                                        metadata=current_metadata,
-                                        prompt=current_prompt,
-                                        last_failure=last_failure_details,
-                                        strictness="max",
-                                    )
-                                    sanitized_meta, safe_additions, heur_summary = rewrite_for_modesty_heuristic(
-                                        new_meta,
-                                        additions,
-                                        strictness="max",
-                                    )
-                                    current_metadata = sanitized_meta
-                                    rebuilt, _ = build_base_text_prompt(current_metadata)
-                                    current_prompt = rebuilt + "\n\n" + safe_additions
-                                    retry_info.append({
-                                        "attempt": attempt + 1,
-                                        "strategy": "gemini_rewrite",
-                                        "reason": "content_rejection",
-                                        "modificationsSummary": f"{gem_summary};{heur_summary}",
-                                    })
-                                except Exception as e:
-                                    # Fall back to heuristic-only if Gemini rewrite fails.
-                                    safe_meta, safe_prompt, summary = rewrite_for_modesty_heuristic(
-                                        current_metadata,
-                                        current_prompt,
-                                        strictness="max",
-                                    )
-                                    current_metadata = safe_meta
-                                    current_prompt = safe_prompt
-                                    retry_info.append({
-                                        "attempt": attempt + 1,
-                                        "strategy": "heuristic",
-                                        "reason": "gemini_rewrite_failed_fallback",
-                                        "modificationsSummary": f"{summary};err={str(e)[:120]}",
-                                    })
-
-                        if attempt == max_attempts:
-                            raise ValueError(f"Gemini API error after {max_attempts} attempts: {response.status_code} - {error_text}")
-                        continue
-                    
-                    data = response.json()
+                if image_url is not None:
+                    logger.info("✅ Successfully generated image using Gemini 3 Pro Image on attempt %d", attempt)
+                    return {
+                        "image_url": image_url,
+                        "retry_info": retry_info,
+                        "modesty_applied": modesty_applied,
+                    }
+
+                # Everything below is the retry (slow) path and only runs after a failed attempt.
+                if failure["reason"] == "http_error":
+                    status_code = failure["status"]
+                    error_text = failure["error_text"]
                     # #region agent log
-                    try:
-                        with open('/Users/gerardgrenville/Change Room/.cursor/debug.log', 'a') as f:
-                            f.write(json_lib.dumps({"location":"vton.py:331","message":"Gemini API response received","data":{"responseKeys":list(data.keys()) if isinstance(data,dict) else None,"hasCandidates":"candidates" in data if isinstance(data,dict) else False,"attempt":attempt},"timestamp":int(__import__('time').time()*1000),"sessionId":"debug-session","runId":"run1","hypothesisId":"E"})+"\n")
-                    except: pass
+                    _agent_log("vton.py:326", "Gemini API request failed", {"statusCode":status_code,"errorText":error_text[:500],"attempt":attempt}, "E", ts_ms=ts_ms, buffer=pending_logs)
                     # #endregion
-                    
-                    # Extract image from response
-                    candidates = data.get("candidates", [])
-                    if not candidates:
-                        logger.error(f"No candidates in response (attempt {attempt}). Full response: {json.dumps(data, indent=2)[:1000]}")
-                        last_failure_details = {"reason": "no_candidates", "response": str(data)[:500]}
-                        should_rewrite = is_content_rejection(error_text=str(data))
-                        if should_rewrite and attempt < max_attempts:
-                            # Treat as content rejection only if keywords suggest it; otherwise just retry.
-                            safe_meta, safe_prompt, summary = rewrite_for_modesty_heuristic(
-                                current_metadata,
-                                build_base_text_prompt(current_metadata)[0],
-                                strictness="moderate",
-                            )
-                            current_metadata = safe_meta
-                            current_prompt = safe_prompt
-                            retry_info.append({
-                                "attempt": attempt + 1,
-                                "strategy": "heuristic",
-                                "reason": "no_candidates",
-                                "modificationsSummary": summary,
-                            })
-                        if attempt == max_attempts:
-                            raise ValueError("No candidates returned from Gemini 3 Pro Image")
-                        continue
-                    
-                    candidate = candidates[0]
-                    finish_reason, safety_ratings, content_parts, text_parts = summarize_candidate(candidate)
-
-                    if safety_ratings:
-                        logger.warning(f"Safety ratings (attempt {attempt}): {safety_ratings}")
-                    if finish_reason:
-                        logger.info(f"Finish reason (attempt {attempt}): {finish_reason}")
-                        if finish_reason != "STOP":
-                            logger.warning(f"Unexpected finish reason (attempt {attempt}): {finish_reason}")
-                    
-                    logger.info(f"Number of parts in response: {len(content_parts)}")
-                    
-                    for i, part in enumerate(content_parts):
-                        logger.info(f"Part {i} keys: {list(part.keys())}")
-                        if "text" in part:
-                            logger.info(f"Part {i} has text: {str(part.get('text', ''))[:100]}")
-                    
-                    # Find the first image in the response
-                    image_part = None
-                    for part in content_parts:
-                        # Try snake_case first (Python API format)
-                        if "inline_data" in part:
-                            inline_data = part["inline_data"]
-                            if inline_data.get("data"):
-                                image_part = inline_data
-                                logger.info(f"Found image in part with inline_data (snake_case)")
-                                break
-                        # Try camelCase (JavaScript API format)
-                        elif "inlineData" in part:
-                            inline_data = part["inlineData"]
-                            if inline_data.get("data"):
-                                image_part = inline_data
-                                logger.info(f"Found image in part with inlineData (camelCase)")
-                                break
-                    
-                    if image_part and finish_reason in (None, "STOP"):
-                        image_base64 = image_part.get("data")
-                        mime_type = image_part.get("mime_type") or image_part.get("mimeType") or "image/png"
-                        
-                        if not image_base64:
-                            last_failure_details = {"reason": "empty_image_data", "finish_reason": finish_reason}
-                            if attempt == max_attempts:
-                                raise ValueError("Image data is empty in Gemini response")
-                            continue
-                        
-                        logger.info(f"✅ Successfully generated image using Gemini 3 Pro Image on attempt {attempt}")
-                        logger.info(f"   Image size: {len(image_base64)} characters (base64), MIME type: {mime_type}")
-                        return {
-                            "image_url": f"data:{mime_type};base64,{image_base64}",
-                            "retry_info": retry_info,
-                            "modesty_applied": modesty_applied,
-                        }
-                    
-                    # If we get here, we either have no image or a non-STOP finish reason
+                    logger.error("Gemini 3 Pro Image failed (attempt %d): %s - %s", attempt, status_code, error_text)
+                    if status_code == 404 and model_check is not None:
+                        try:
+                            verified_model = _verified_image_model(model_name, await model_check)
+                        except Exception as e:
+                            logger.warning(f"Could not verify model availability: {e}")
+                            verified_model = model_name
+                        model_check = None
+                        if verified_model != model_name:
+                            model_name = verified_model
+                            url = f"{base_url}/{model_name}:generateContent?key={api_key}"
                     last_failure_details = {
-                        "reason": "no_image_or_finish_reason",
-                        "finish_reason": finish_reason,
-                        "text": text_parts[:2] if text_parts else [],
-                        "has_image": bool(image_part),
+                        "reason": "http_error",
+                        "status": status_code,
+                        "error": error_text[:800],
                         "attempt": attempt,
-                        "safety_ratings": safety_ratings,
                     }
-                    logger.warning(f"No usable image on attempt {attempt}. Details: {last_failure_details}")
-                    # #region agent log
-                    try:
-                        with open('/Users/gerardgrenville/Change Room/.cursor/debug.log', 'a') as f:
-                            f.write(json_lib.dumps({"location":"vton.py:386","message":"No image part in response","data":{"contentPartsCount":len(content_parts),"finishReason":finish_reason,"attempt":attempt,"text":text_parts[:2] if text_parts else []},"timestamp":int(__import__('time').time()*1000),"sessionId":"debug-session","runId":"run1","hypothesisId":"E"})+"\n")
-                    except: pass
-                    # #endregion
-                    
+
                     should_rewrite = is_content_rejection(
-                        finish_reason=finish_reason,
-                        error_text=(text_parts[0] if text_parts else ""),
-                        safety_ratings=safety_ratings,
+                        http_status=status_code,
+                        error_text=error_text,
                     )
                     if should_rewrite and attempt < max_attempts:
-                        if attempt == 1:
-                            safe_meta, safe_prompt, summary = rewrite_for_modesty_heuristic(
-                                current_metadata,
-                                build_base_text_prompt(current_metadata)[0],
-                                strictness="moderate",
-                            )
-                            current_metadata = safe_meta
-                            current_prompt = safe_prompt
-                            retry_info.append({
-                                "attempt": attempt + 1,
-                                "strategy": "heuristic",
-                                "reason": "content_rejection",
-                                "modificationsSummary": summary,
-                            })
-                        elif attempt == 2:
-                            try:
-                                new_meta, additions, gem_summary = await rewrite_for_modesty_gemini(
-                                    client,
-                                    api_key=api_key,
-                                    metadata=current_metadata,
-                                    prompt=current_prompt,
-                                    last_failure=last_failure_details,
-                                    strictness="moderate",
-                                )
-                                sanitized_meta, safe_additions, heur_summary = rewrite_for_modesty_heuristic(
-                                    new_meta,
-                                    additions,
-                                    strictness="moderate",
-                                )
-                                current_metadata = sanitized_meta
-                                rebuilt, _ = build_base_text_prompt(current_metadata)
-                                current_prompt = rebuilt + "\n\n" + safe_additions
-                                retry_info.append({
-                                    "attempt": attempt + 1,
-                                    "strategy": "gemini_rewrite",
-                                    "reason": "content_rejection",
-                                    "modificationsSummary": f"{gem_summary};{heur_summary}",
-                                })
-                            except Exception as e:
-                                safe_meta, safe_prompt, summary = rewrite_for_modesty_heuristic(
-                                    current_metadata,
-                                    current_prompt,
-                                    strictness="moderate",
-                                )
-                                current_metadata = safe_meta
-                                current_prompt = safe_prompt
-                                retry_info.append({
-                                    "attempt": attempt + 1,
-                                    "strategy": "heuristic",
-                                    "reason": "gemini_rewrite_failed_fallback",
-                                    "modificationsSummary": f"{summary};err={str(e)[:120]}",
-                                })
-                        elif attempt == 3:
-                            try:
-                                new_meta, additions, gem_summary = await rewrite_for_modesty_gemini(
-                                    client,
-                                    api_key=api_key,
-                                    metadata=current_metadata,
-                                    prompt=current_prompt,
-                                    last_failure=last_failure_details,
-                                    strictness="max",
-                                )
-                                sanitized_meta, safe_additions, heur_summary = rewrite_for_modesty_heuristic(
-                                    new_meta,
-                                    additions,
-                                    strictness="max",
-                                )
-                                current_metadata = sanitized_meta
-                                rebuilt, _ = build_base_text_prompt(current_metadata)
-                                current_prompt = rebuilt + "\n\n" + safe_additions
-                                retry_info.append({
-                                    "attempt": attempt + 1,
-                                    "strategy": "gemini_rewrite",
-                                    "reason": "content_rejection",
-                                    "modificationsSummary": f"{gem_summary};{heur_summary}",
-                                })
-                            except Exception as e:
-                                safe_meta, safe_prompt, summary = rewrite_for_modesty_heuristic(
-                                    current_metadata,
-                                    current_prompt,
-                                    strictness="max",
-                                )
-                                current_metadata = safe_meta
-                                current_prompt = safe_prompt
-                                retry_info.append({
-                                    "attempt": attempt + 1,
-                                    "strategy": "heuristic",
-                                    "reason": "gemini_rewrite_failed_fallback",
-                                    "modificationsSummary": f"{summary};err={str(e)[:120]}",
-                                })
+                        await apply_rewrite(attempt)
 
                     if attempt == max_attempts:
-                        readable_text = text_parts[0][:300] if text_parts else ""
-                        safety_hint = ""
-                        if (finish_reason or "").upper() == "IMAGE_SAFETY" or should_rewrite or ((finish_reason or "").upper().startswith("IMAGE_")):
-                            safety_hint = " The request was blocked by image safety filters. Please use a less revealing garment description or select a different item."
-                        raise ValueError(f"No image generated after {max_attempts} attempts. Finish reason: {finish_reason or 'UNKNOWN'}. Model message: {readable_text}.{safety_hint}")
+                        raise ValueError(f"Gemini API error after {max_attempts} attempts: {status_code} - {error_text}")
+                    await _sleep_before_retry(attempt, retry_after=failure["retry_after"])
                     continue
-
-                except httpx.TimeoutException as e:
-                    # #region agent log
-                    try:
-                        with open('/Users/gerardgrenville/Change Room/.cursor/debug.log', 'a') as f:
-                            f.write(json_lib.dumps({"location":"vton.py:401","message":"Gemini API timeout","data":{"error":str(e),"attempt":attempt},"timestamp":int(__import__('time').time()*1000),"sessionId":"debug-session","runId":"run1","hypothesisId":"F"})+"\n")
-                    except: pass
-                    # #endregion
-                    logger.error(f"Timeout calling Gemini 3 Pro Image on attempt {attempt}: {e}")
-                    last_failure_details = {"reason": "timeout", "error": str(e), "attempt": attempt}
+                
+                # #region agent log
+                _agent_log("vton.py:331", "Gemini API response received", {"responseKeys":failure["response_keys"],"hasCandidates":failure["reason"] != "no_candidates","attempt":attempt}, "E", ts_ms=ts_ms, buffer=pending_logs)
+                # #endregion
+                
+                if failure["reason"] == "no_candidates":
+                    response_summary = failure["response_summary"]
+                    logger.error("No candidates in response (attempt %d). Response summary: %s", attempt, response_summary)
+                    last_failure_details = {"reason": "no_candidates", "response": response_summary[:500]}
+                    should_rewrite = is_content_rejection(error_text=response_summary)
+                    if should_rewrite and attempt < max_attempts:
+                        # Treat as content rejection only if keywords suggest it; otherwise just retry.
+                        await apply_rewrite(attempt, reason="no_candidates", heuristic_only=True)
                     if attempt == max_attempts:
-                        raise ValueError(f"Request timed out after {max_attempts} attempts. Please try again.")
+                        raise ValueError("No candidates returned from Gemini 3 Pro Image")
+                    await _sleep_before_retry(attempt)
                     continue
-                except Exception as e:
-                    # #region agent log
-                    try:
-                        with open('/Users/gerardgrenville/Change Room/.cursor/debug.log', 'a') as f:
-                            f.write(json_lib.dumps({"location":"vton.py:404","message":"Gemini API call error","data":{"errorType":type(e).__name__,"errorMessage":str(e),"attempt":attempt},"timestamp":int(__import__('time').time()*1000),"sessionId":"debug-session","runId":"run1","hypothesisId":"E"})+"\n")
-                    except: pass
-                    # #endregion
-                    logger.error(f"Error calling Gemini 3 Pro Image on attempt {attempt}: {e}")
-                    last_failure_details = {"reason": "exception", "error": str(e), "attempt": attempt}
+                
+                if failure["reason"] == "empty_image_data":
+                    last_failure_details = {"reason": "empty_image_data", "finish_reason": failure["finish_reason"]}
                     if attempt == max_attempts:
-                        raise
+                        raise ValueError("Image data is empty in Gemini response")
+                    await _sleep_before_retry(attempt, model_fault=True)
                     continue
-            
+
+                finish_reason = failure["finish_reason"]
+                safety_ratings = failure["safety_ratings"]
+                text_parts = failure["text_parts"]
+                # If we get here, we either have no image or a non-STOP finish reason
+                last_failure_details = {
+                    "reason": "no_image_or_finish_reason",
+                    "finish_reason": finish_reason,
+                    "text": text_parts[:2] if text_parts else [],
+                    "has_image": failure["has_image"],
+                    "attempt": attempt,
+                    "safety_ratings": safety_ratings,
+                }
+                logger.warning("No usable image on attempt %d. Details: %s", attempt, last_failure_details)
+                # #region agent log
+                _agent_log("vton.py:386", "No image part in response", {"contentPartsCount":failure["parts_count"],"finishReason":finish_reason,"attempt":attempt,"text":text_parts[:2] if text_parts else []}, "E", ts_ms=ts_ms, buffer=pending_logs)
+                # #endregion
+                
+                should_rewrite = is_content_rejection(
+                    finish_reason=finish_reason,
+                    error_text=(text_parts[0] if text_parts else ""),
+                    safety_ratings=safety_ratings,
+                )
+                if should_rewrite and attempt < max_attempts:
+                    await apply_rewrite(attempt)
+
+                if attempt == max_attempts:
+                    readable_text = text_parts[0][:300] if text_parts else ""
+                    safety_hint = ""
+                    if (finish_reason or "").upper() == "IMAGE_SAFETY" or should_rewrite or ((finish_reason or "").upper().startswith("IMAGE_")):
+                        safety_hint = " The request was blocked by image safety filters. Please use a less revealing garment description or select a different item."
+                    raise ValueError(f"No image generated after {max_attempts} attempts. Finish reason: {finish_reason or 'UNKNOWN'}. Model message: {readable_text}.{safety_hint}")
+                await _sleep_before_retry(attempt, model_fault=True)
+                continue
+
+            except httpx.TimeoutException as e:
+                # #region agent log
+                _agent_log("vton.py:401", "Gemini API timeout", {"error":str(e),"attempt":attempt}, "F", ts_ms=ts_ms, buffer=pending_logs)
+                # #endregion
+                logger.error("Timeout calling Gemini 3 Pro Image on attempt %d: %s", attempt, e)
+                last_failure_details = {"reason": "timeout", "error": str(e), "attempt": attempt}
+                if attempt == max_attempts:
+                    raise ValueError(f"Request timed out after {max_attempts} attempts. Please try again.")
+                await _sleep_before_retry(attempt)
+                continue
+            except Exception as e:
+                # #region agent log
+                _agent_log("vton.py:404", "Gemini API call error", {"errorType":type(e).__name__,"errorMessage":str(e),"attempt":attempt}, "E", ts_ms=ts_ms, buffer=pending_logs)
+                # #endregion
+                logger.error("Error calling Gemini 3 Pro Image on attempt %d: %s", attempt, e)
+                last_failure_details = {"reason": "exception", "error": str(e), "attempt": attempt}
+                if attempt == max_attempts:
+                    raise
+                await _sleep_before_retry(attempt)
+                continue
+            finally:
+                # #region agent log
+                _flush_agent_log(pending_logs)
+                # #endregion
+        
     except Exception as e:
         # #region agent log
-        try:
-            with open('/Users/gerardgrenville/Change Room/.cursor/debug.log', 'a') as f:
-                f.write(json_lib.dumps({"location":"vton.py:408","message":"vton.generate_try_on error","data":{"errorType":type(e).__name__,"errorMessage":str(e)},"timestamp":int(__import__('time').time()*1000),"sessionId":"debug-session","runId":"run1","hypothesisId":"B"})+"\n")
-        except: pass
+        _agent_log("vton.py:408", "vton.generate_try_on error", {"errorType":type(e).__name__,"errorMessage":str(e)}, "B")
         # #endregion
         logger.error(f"Error in Gemini 3 Pro Image generation: {e}", exc_info=True)
         raise e
@@ -13,10 +13,23 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 # Set test environment variables before importing app
 os.environ.setdefault("GEMINI_API_KEY", "test-key")
 os.environ.setdefault("GOOGLE_API_KEY", "test-key")
+# No real backoff between stubbed Gemini retry attempts.
+os.environ.setdefault("GEMINI_RETRY_BACKOFF_BASE_S", "0")
+os.environ.setdefault("GEMINI_RETRY_MODEL_BACKOFF_BASE_S", "0")
 
 from main import app
 
 
+@pytest.fixture(autouse=True)
+def clear_vton_result_cache():
+    """Each test starts with an empty try-on result cache."""
+    from services import vton
+
+    vton._RESULT_CACHE.clear()
+    yield
+    vton._RESULT_CACHE.clear()
+
+
 @pytest.fixture
 def client():
     """Create a test client for the FastAPI app"""
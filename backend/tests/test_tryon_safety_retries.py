@@ -1,4 +1,5 @@
 import io
+import json
 import pytest
 
 
@@ -20,6 +21,15 @@ def test_is_content_rejection_finish_reason():
     assert is_content_rejection(finish_reason="STOP") is False
 
 
+def test_retry_delay_is_exponential_jittered_and_capped():
+    from services.vton import _retry_delay_s
+
+    for attempt in (1, 2, 3):
+        delay = _retry_delay_s(attempt, base=1.0)
+        assert 2 ** (attempt - 1) <= delay <= 2 ** (attempt - 1) * 1.5
+    assert _retry_delay_s(10, base=1.0) == 30.0
+
+
 def test_heuristic_rewrite_sanitizes_and_adds_defaults():
     from services.vton import rewrite_for_modesty_heuristic
 
@@ -227,3 +237,613 @@ def test_try_on_endpoint_includes_retry_info(client, sample_image_bytes, monkeyp
     assert isinstance(payload["retry_info"], list)
     assert payload.get("modesty_applied") is True
 
+
+
+@pytest.mark.asyncio
+async def test_identical_try_on_requests_hit_result_cache(monkeypatch, sample_image_bytes):
+    from services import vton
+
+    calls = {"image": 0}
+
+    async def fake_post(_client, *, url, headers, payload):
+        if "responseModalities" not in payload.get("generationConfig", {}):
+            # Vision preflight / rewrite calls: not under test here.
+            return DummyGeminiResponse(ok=False, status_code=500, text="not stubbed")
+        calls["image"] += 1
+        return DummyGeminiResponse(
+            ok=True,
+            data={
+                "candidates": [
+                    {
+                        "finishReason": "STOP",
+                        "content": {"parts": [{"inline_data": {"data": "AAAA", "mime_type": "image/png"}}]},
+                    }
+                ]
+            },
+        )
+
+    monkeypatch.setattr(vton, "_gemini_post_json", fake_post)
+
+    async def run(**kwargs):
+        return await vton.generate_try_on(
+            [io.BytesIO(sample_image_bytes)],
+            [io.BytesIO(sample_image_bytes)],
+            category="upper_body",
+            garment_metadata={"description": "denim jacket"},
+            **kwargs,
+        )
+
+    first = await run()
+    second = await run()
+    assert first["image_url"] == second["image_url"]
+    image_calls_after_two = calls["image"]
+    await run(no_cache=True)
+    assert calls["image"] == image_calls_after_two + 1
+
+
+def test_split_inline_image_keeps_payload_out_of_parsed_body():
+    import json
+
+    from services.vton import _INLINE_DATA_SENTINEL, _split_inline_image
+
+    payload = "QUJD" * 100_000
+    raw = json.dumps(
+        {
+            "candidates": [
+                {
+                    "finishReason": "STOP",
+                    "content": {"parts": [{"text": "ok"}, {"inlineData": {"mimeType": "image/png", "data": payload}}]},
+                }
+            ]
+        }
+    ).encode("utf-8")
+
+    body, image_b64 = _split_inline_image(raw)
+    assert image_b64 == payload.encode("ascii")
+    parsed = json.loads(body)
+    inline = parsed["candidates"][0]["content"]["parts"][1]["inlineData"]
+    assert inline == {"mimeType": "image/png", "data": _INLINE_DATA_SENTINEL}
+
+    assert _split_inline_image(b'{"candidates": []}') == (b'{"candidates": []}', None)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_try_on_requests_share_one_generation(monkeypatch, sample_image_bytes):
+    import asyncio
+
+    from services import vton
+
+    calls = {"generate": 0}
+
+    async def fake_generate(*_args, **_kwargs):
+        calls["generate"] += 1
+        await asyncio.sleep(0.01)
+        return {"image_url": "data:image/png;base64,AAAA", "retry_info": [], "modesty_applied": False}
+
+    monkeypatch.setattr(vton, "_generate_with_gemini", fake_generate)
+
+    results = await asyncio.gather(
+        *[
+            vton.generate_try_on([io.BytesIO(sample_image_bytes)], [io.BytesIO(sample_image_bytes)])
+            for _ in range(3)
+        ]
+    )
+    assert calls["generate"] == 1
+    assert all(r["image_url"] == "data:image/png;base64,AAAA" for r in results)
+    assert vton._INFLIGHT == {}
+
+
+def test_agent_log_buffer_is_written_in_one_flush(monkeypatch, tmp_path):
+    from services import vton
+
+    log_path = tmp_path / "debug.log"
+    monkeypatch.setattr(vton, "_AGENT_LOG_PATH", str(log_path))
+
+    pending = []
+    vton._append_agent_log("a", "first", {}, "E", ts_ms=1, buffer=pending)
+    vton._append_agent_log("b", "second", {}, "E", ts_ms=1, buffer=pending)
+    assert not log_path.exists()
+
+    vton._flush_agent_log_buffer(pending)
+    lines = log_path.read_text().splitlines()
+    assert [json.loads(line)["message"] for line in lines] == ["first", "second"]
+    assert pending == []
+
+
+def test_response_text_head_slices_raw_bytes_before_decoding():
+    from services import vton
+
+    class RawResponse:
+        content = b'{"error": "blocked"}' + b"x" * 100_000
+
+        @property
+        def text(self):
+            raise AssertionError("full body should not be decoded")
+
+    head = vton._response_text_head(RawResponse(), limit=20)
+    assert head == '{"error": "blocked"}'
+    assert vton._response_text_head(DummyGeminiResponse(ok=False, text="short")) == "short"
+
+
+def test_agent_log_is_a_no_op_unless_enabled():
+    from services import vton
+
+    if vton._AGENT_LOG_ENABLED:
+        pytest.skip("VTON_DEBUG_LOG=1 in this environment")
+    assert vton._agent_log is vton._agent_log_disabled
+    assert vton._flush_agent_log is vton._agent_log_disabled
+
+
+def test_heuristic_sanitizer_does_not_rescan_replacements():
+    from services.vton import rewrite_for_modesty_heuristic
+
+    _, prompt, _ = rewrite_for_modesty_heuristic({}, "A see-through Sheer BRA for pole dancing", strictness="moderate")
+    assert prompt.startswith("A semi-transparent semi-transparent supportive top for fitness wear")
+    assert "semi-semi" not in prompt
+
+
+def test_clothing_sanitizer_matches_whole_words_and_keeps_case():
+    from services.vton import _sanitize_clothing_description
+
+    assert _sanitize_clothing_description("Black Lace Bralette with Zebra print") == "Black Lace Supportive top with Zebra print"
+    assert _sanitize_clothing_description("Lingerie set") == "Delicate apparel set"
+    assert _sanitize_clothing_description("three_quarter") == "three_quarter"
+    assert _sanitize_clothing_description(None) is None
+
+
+@pytest.mark.asyncio
+async def test_read_image_bytes_async_reads_file_objects_in_order(tmp_path):
+    from services import vton
+
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"img{i}.bin"
+        path.write_bytes(bytes([i]) * 4)
+        paths.append(path)
+
+    handles = [open(path, "rb") for path in paths]
+    try:
+        result = await vton._read_image_bytes_async([*handles, b"raw", io.BytesIO(b"mem")])
+    finally:
+        for handle in handles:
+            handle.close()
+    assert result == [b"\x00" * 4, b"\x01" * 4, b"\x02" * 4, b"raw", b"mem"]
+
+
+def test_passthrough_only_for_upright_native_images_within_bounds():
+    from PIL import Image as PILImage
+
+    from services import vton
+
+    def encode(mode, size, fmt):
+        buf = io.BytesIO()
+        PILImage.new(mode, size).save(buf, format=fmt)
+        return buf.getvalue()
+
+    jpeg = encode("RGB", (64, 32), "JPEG")
+    assert vton._passthrough_image_mime(jpeg, PILImage.open(io.BytesIO(jpeg)), max_dim=64) == "image/jpeg"
+    assert vton._passthrough_image_mime(jpeg, PILImage.open(io.BytesIO(jpeg)), max_dim=63) is None
+
+    opaque_png = encode("RGB", (32, 32), "PNG")
+    assert vton._passthrough_image_mime(opaque_png, PILImage.open(io.BytesIO(opaque_png)), max_dim=64) is None
+    alpha_png = encode("RGBA", (32, 32), "PNG")
+    assert vton._passthrough_image_mime(alpha_png, PILImage.open(io.BytesIO(alpha_png)), max_dim=64) == "image/png"
+
+
+@pytest.mark.asyncio
+async def test_shared_http_client_is_created_lazily_and_recreated_after_close():
+    from services import http_clients
+
+    client = http_clients.get_gemini_client()
+    assert http_clients.get_gemini_client() is client
+    await http_clients.close_gemini_client()
+    assert client.is_closed
+    assert http_clients._GEMINI_CLIENT is None
+    replacement = http_clients.get_gemini_client()
+    assert replacement is not client
+    await http_clients.close_gemini_client()
+
+
+def test_heuristic_rewrite_leaves_caller_metadata_untouched():
+    from services.vton import rewrite_for_modesty_heuristic
+
+    meta = {"description": "sheer top", "tags": ["sexy"], "nested": {"note": "lingerie"}}
+    new_meta, _, _ = rewrite_for_modesty_heuristic(meta, "prompt", strictness="moderate")
+    assert meta == {"description": "sheer top", "tags": ["sexy"], "nested": {"note": "lingerie"}}
+    assert new_meta["tags"] == ["stylish"]
+    assert new_meta["nested"] is not meta["nested"]
+
+
+def test_text_payload_template_matches_full_encoding():
+    from services import vton
+
+    def build(text):
+        return {"contents": [{"parts": [{"text": text}, {"inline_data": {"data": "QUJD"}}]}], "cfg": {"x": 1}}
+
+    template = vton._TextPayloadTemplate(build)
+    for text in ("plain", 'quote " and\nnewline', "unicode ✓"):
+        payload = template.render(text)
+        assert payload == build(text)
+        assert json.loads(vton._encode_json_body(payload)) == build(text)
+
+
+@pytest.mark.asyncio
+async def test_speculative_retry_sends_heuristic_rewrite_alongside_baseline(monkeypatch, sample_image_bytes):
+    from services import vton
+
+    prompts = []
+
+    async def fake_post(_client, *, url, headers, payload):
+        if "responseModalities" not in payload.get("generationConfig", {}):
+            return DummyGeminiResponse(ok=False, status_code=500, text="not stubbed")
+        text = payload["contents"][0]["parts"][0]["text"]
+        prompts.append(text)
+        if "RETRY:" not in text:
+            return DummyGeminiResponse(
+                ok=True,
+                data={"candidates": [{"finishReason": "IMAGE_SAFETY", "content": {"parts": [{"text": "Blocked"}]}}]},
+            )
+        return DummyGeminiResponse(
+            ok=True,
+            data={
+                "candidates": [
+                    {
+                        "finishReason": "STOP",
+                        "content": {"parts": [{"inline_data": {"data": "AAAA", "mime_type": "image/png"}}]},
+                    }
+                ]
+            },
+        )
+
+    monkeypatch.setattr(vton, "_gemini_post_json", fake_post)
+    monkeypatch.setenv("GEMINI_SPECULATIVE_RETRY", "1")
+
+    result = await vton.generate_try_on(
+        [io.BytesIO(sample_image_bytes)],
+        [io.BytesIO(sample_image_bytes)],
+        category="upper_body",
+        garment_metadata={"description": "denim jacket"},
+    )
+
+    assert result["image_url"].startswith("data:image/")
+    assert len(prompts) == 2
+    assert [r["reason"] for r in result["retry_info"]] == ["speculative"]
+
+
+def test_is_content_rejection_keyword_scan_is_case_insensitive():
+    from services.vton import is_content_rejection
+
+    assert is_content_rejection(http_status=400, error_text="Request BLOCKED by Content Policy") is True
+    assert is_content_rejection(error_text="NSFW") is True
+    assert is_content_rejection(http_status=500, error_text="internal error") is False
+    assert is_content_rejection(error_text=None) is False
+
+
+@pytest.mark.asyncio
+async def test_available_models_are_listed_once_per_process(monkeypatch):
+    from services import vton
+
+    calls = {"get": 0}
+
+    class FakeClient:
+        async def get(self, url, timeout=None):
+            calls["get"] += 1
+            return DummyGeminiResponse(ok=True, data={"models": [{"name": "models/gemini-3-pro-image-preview"}]})
+
+    monkeypatch.setattr(vton, "get_gemini_client", lambda: FakeClient())
+    monkeypatch.setattr(vton, "_AVAILABLE_MODELS", None)
+
+    first = await vton._available_models("https://example.invalid/models", "k")
+    second = await vton._available_models("https://example.invalid/models", "k")
+    assert first == second == ["gemini-3-pro-image-preview"]
+    assert calls["get"] == 1
+
+
+@pytest.mark.asyncio
+async def test_large_inline_image_becomes_data_url_from_raw_body(monkeypatch):
+    from services import vton
+
+    image_b64 = "QUJD" * 100_000
+
+    class RawResponse:
+        is_success = True
+        status_code = 200
+        content = json.dumps(
+            {
+                "candidates": [
+                    {"finishReason": "STOP", "content": {"parts": [{"inlineData": {"mimeType": "image/jpeg", "data": image_b64}}]}}
+                ]
+            }
+        ).encode("utf-8")
+
+    async def fake_post(_client, *, url, headers, payload):
+        return RawResponse()
+
+    monkeypatch.setattr(vton, "_gemini_post_json", fake_post)
+    data_url, failure = await vton._call_gemini_once(None, url="u", payload={}, attempt=1)
+    assert failure is None
+    assert data_url == "data:image/jpeg;base64," + image_b64
+
+
+@pytest.mark.asyncio
+async def test_try_on_does_not_mutate_caller_metadata(monkeypatch, sample_image_bytes):
+    import copy
+
+    from services import vton
+
+    calls = {"image": 0}
+
+    async def fake_post(_client, *, url, headers, payload):
+        if "responseModalities" not in payload.get("generationConfig", {}):
+            return DummyGeminiResponse(ok=False, status_code=500, text="not stubbed")
+        calls["image"] += 1
+        if calls["image"] == 1:
+            return DummyGeminiResponse(
+                ok=True,
+                data={"candidates": [{"finishReason": "IMAGE_SAFETY", "content": {"parts": [{"text": "Blocked"}]}}]},
+            )
+        return DummyGeminiResponse(
+            ok=True,
+            data={
+                "candidates": [
+                    {
+                        "finishReason": "STOP",
+                        "content": {"parts": [{"inline_data": {"data": "AAAA", "mime_type": "image/png"}}]},
+                    }
+                ]
+            },
+        )
+
+    monkeypatch.setattr(vton, "_gemini_post_json", fake_post)
+    meta = {"description": "sheer lingerie top", "wearing_instructions": ["tuck in"], "items": [{"label": "bra"}]}
+    original = copy.deepcopy(meta)
+
+    result = await vton.generate_try_on(
+        [io.BytesIO(sample_image_bytes)],
+        [io.BytesIO(sample_image_bytes)],
+        category="upper_body",
+        garment_metadata=meta,
+    )
+
+    assert result["image_url"].startswith("data:image/")
+    assert result["modesty_applied"] is True
+    assert meta == original
+
+
+@pytest.mark.asyncio
+async def test_preencoded_try_on_body_is_sent_verbatim_and_parses_to_payload():
+    from services import vton
+
+    sent = {}
+
+    class CapturingClient:
+        async def post(self, url, *, headers, content):
+            sent["headers"] = headers
+            sent["content"] = content
+            return DummyGeminiResponse(ok=True)
+
+    def build(text):
+        return {
+            "contents": [{"role": "user", "parts": [{"text": text}, {"inline_data": {"mime_type": "image/jpeg", "data": "QUJD"}}]}],
+            "generationConfig": vton._TRY_ON_GENERATION_CONFIG,
+            "safetySettings": vton._TRY_ON_SAFETY_SETTINGS,
+        }
+
+    payload = vton._TextPayloadTemplate(build).render("prompt with \"quotes\"")
+    await vton._gemini_post_json(CapturingClient(), url="u", headers={}, payload=payload)
+    assert sent["content"] is payload.encoded
+    assert sent["headers"]["Content-Type"] == "application/json"
+    assert json.loads(sent["content"]) == build("prompt with \"quotes\"")
+
+
+def test_analysis_sanitizer_is_one_whole_word_pass():
+    from services.analyze_clothing import _ANALYSIS_REPLACEMENTS, _ANALYSIS_TERMS_RE
+
+    def sanitize(value):
+        return _ANALYSIS_TERMS_RE.sub(lambda m: _ANALYSIS_REPLACEMENTS[m.group(0).lower()], value)
+
+    assert sanitize("Lingerie top with bralette") == "delicate top with structured top"
+    assert sanitize("bras from a zebra brand") == "structured tops from a zebra brand"
+    assert sanitize("see-through mesh") == "semi-sheer lightweight mesh"
+
+
+def test_trie_pattern_prefers_longest_term_like_an_alternation():
+    import re
+
+    from services.vton import _trie_pattern
+
+    assert _trie_pattern(["bra", "bralette", "bikini"]) == "b(?:ikini|ra(?:lette)?)"
+    pattern = re.compile(r"\b" + _trie_pattern(["lingerie", "lingerie top", "bra"]) + r"\b", re.IGNORECASE)
+    assert pattern.findall("Lingerie Top, lingerie topper and a bra") == ["Lingerie Top", "lingerie", "bra"]
+
+
+def test_passthrough_skips_oversized_high_quality_jpeg():
+    import os
+
+    from PIL import Image as PILImage
+
+    from services import vton
+
+    noisy = PILImage.frombytes("RGB", (400, 400), os.urandom(400 * 400 * 3))
+    buf = io.BytesIO()
+    noisy.save(buf, format="JPEG", quality=100)
+    dense = buf.getvalue()
+    assert len(dense) > 400 * 400 * vton._PASSTHROUGH_MAX_BYTES_PER_PIXEL
+    assert vton._passthrough_image_mime(dense, PILImage.open(io.BytesIO(dense)), max_dim=512) is None
+
+
+def test_scratch_buffer_is_reused_and_cleared_per_thread():
+    from services import vton
+
+    buf = vton._scratch_buffer()
+    buf.write(b"first encode")
+    assert vton._b64encode_str(buf.getbuffer()) == "Zmlyc3QgZW5jb2Rl"
+
+    again = vton._scratch_buffer()
+    assert again is buf
+    assert again.getbuffer().nbytes == 0
+
+    held = buf.getbuffer()  # an outstanding view must not block the next encode
+    assert vton._scratch_buffer() is not buf
+    held.release()
+
+
+def test_budget_solver_predicts_from_area_and_quality():
+    from services import vton
+
+    start = {
+        "main_user_dim": 2200, "other_user_dim": 1600, "first_garment_dim": 1800, "other_garment_dim": 1400,
+        "main_user_q": 90, "other_user_q": 82, "first_garment_q": 86, "other_garment_q": 80,
+    }
+    step = vton._shrink_encode_targets(start, min_main_user_dim=1600, min_main_user_jpeg_quality=82)
+    assert step["other_user_dim"] == 1360 and step["other_user_q"] == 78
+    assert step["main_user_dim"] == 2024 and step["main_user_q"] == 88
+
+    measured = [
+        (1_000_000, 4000, "other_user_dim", "other_user_q"),
+        (500_000, 1000, "main_user_dim", "main_user_q"),  # already smaller than either target
+    ]
+    predicted = vton._predict_encoded_bytes(measured, start, step)
+    expected = 1_000_000 * (1360 / 1600) ** 2 * 0.95 ** 4 + 500_000 * 0.95 ** 2
+    assert abs(predicted - expected) < 1e-6
+
+
+@pytest.mark.asyncio
+async def test_batched_rewrite_prefetches_max_strictness(monkeypatch, sample_image_bytes):
+    from services import vton
+
+    monkeypatch.setenv("GEMINI_REWRITE_BATCH", "1")
+    monkeypatch.setenv("GEMINI_INTIMATE_DETECT_ENABLED", "0")
+    calls = {"rewrite": [], "image": 0}
+    blocked = {"candidates": [{"finishReason": "IMAGE_SAFETY", "content": {"parts": [{"text": "Blocked"}]}}]}
+
+    async def fake_post(_client, *, url, headers, payload):
+        if "responseModalities" not in payload.get("generationConfig", {}):
+            text = payload["contents"][0]["parts"][0]["text"]
+            calls["rewrite"].append(text)
+            result = {"prompt_additions": "Opaque layers.", "metadata": {"description": "top"}, "changes": ["x"]}
+            return DummyGeminiResponse(
+                ok=True,
+                data={"candidates": [{"content": {"parts": [{"text": json.dumps({"results": [result, result]})}]}}]},
+            )
+        calls["image"] += 1
+        if calls["image"] <= 3:
+            return DummyGeminiResponse(ok=True, data=blocked)
+        return DummyGeminiResponse(
+            ok=True,
+            data={"candidates": [{"finishReason": "STOP", "content": {"parts": [{"inline_data": {"data": "AAAA", "mime_type": "image/png"}}]}}]},
+        )
+
+    monkeypatch.setattr(vton, "_gemini_post_json", fake_post)
+    result = await vton.generate_try_on(
+        [io.BytesIO(sample_image_bytes)], [io.BytesIO(sample_image_bytes)], garment_metadata={"description": "top"}
+    )
+
+    assert result["image_url"].startswith("data:image/")
+    assert len(calls["rewrite"]) == 1 and '"jobs"' in calls["rewrite"][0]
+    gemini_entries = [r for r in result["retry_info"] if r.get("strategy") == "gemini_rewrite"]
+    assert [r["attempt"] for r in gemini_entries] == [3, 4]
+    assert "strictness=max" in gemini_entries[1]["modificationsSummary"]
+
+
+@pytest.mark.asyncio
+async def test_gemini_rewrite_rejects_non_object_reply_before_parsing(monkeypatch):
+    from services import vton
+
+    async def fake_post(_client, *, url, headers, payload):
+        reply = "[" + ", ".join(["{\"metadata\": {}}"] * 500) + "]"
+        return DummyGeminiResponse(ok=True, data={"candidates": [{"content": {"parts": [{"text": reply}]}}]})
+
+    def fail_loads(_text):
+        raise AssertionError("non-object reply should not be parsed")
+
+    monkeypatch.setattr(vton, "_gemini_post_json", fake_post)
+    monkeypatch.setattr(vton, "_loads_json", fail_loads)
+    with pytest.raises(RuntimeError, match="gemini_rewrite_non_object_json"):
+        await vton.rewrite_for_modesty_gemini(
+            api_key="k", metadata={}, prompt="p", last_failure={}, strictness="moderate"
+        )
+
+
+def test_code_fence_strip_is_one_pass():
+    from services.vton import _CODE_FENCE_RE
+
+    assert _CODE_FENCE_RE.sub("", '```json\n{"a": "x```y"}\n```').strip() == '{"a": "x```y"}'
+    assert _CODE_FENCE_RE.sub("", "```").strip() == ""
+
+
+def test_intimate_keyword_walk_matches_keys_and_nested_leaves():
+    from services.vton import _contains_intimate_keyword
+
+    assert _contains_intimate_keyword({"items_wearing_styles": [{"tags": ["casual", "Sheer"]}]}) is True
+    assert _contains_intimate_keyword({"lingerie_notes": 1}) is True
+    assert _contains_intimate_keyword({"description": "Blue cotton tee", "layer": 2, "tags": None}) is False
+    assert _contains_intimate_keyword(None) is False
+
+
+def test_intimate_detect_image_is_downscaled_jpeg():
+    import base64
+
+    from PIL import Image as PILImage
+
+    from services import vton
+
+    buf = io.BytesIO()
+    PILImage.new("RGB", (2400, 1200), (120, 30, 30)).save(buf, format="JPEG")
+    b64, mime = vton._prepare_intimate_detect_image(buf.getvalue(), max_dim=900)
+
+    assert mime == "image/jpeg"
+    assert PILImage.open(io.BytesIO(base64.b64decode(b64))).size == (900, 450)
+
+
+@pytest.mark.asyncio
+async def test_model_listing_runs_alongside_first_attempt_and_switches_on_404(monkeypatch, sample_image_bytes):
+    from services import vton
+
+    monkeypatch.setenv("GEMINI_INTIMATE_DETECT_ENABLED", "0")
+    monkeypatch.setattr(vton, "_VERIFY_MODEL", True)
+    monkeypatch.setattr(vton, "_AVAILABLE_MODELS", None)
+    urls = []
+
+    class FakeClient:
+        async def get(self, url, timeout=None):
+            return DummyGeminiResponse(ok=True, data={"models": [{"name": "models/gemini-alt-image"}]})
+
+    async def fake_post(_client, *, url, headers, payload):
+        urls.append(url)
+        if "gemini-3-pro-image-preview" in url:
+            return DummyGeminiResponse(ok=False, status_code=404, text="model not found")
+        return DummyGeminiResponse(
+            ok=True,
+            data={"candidates": [{"finishReason": "STOP", "content": {"parts": [{"inline_data": {"data": "AAAA", "mime_type": "image/png"}}]}}]},
+        )
+
+    monkeypatch.setattr(vton, "get_gemini_client", lambda: FakeClient())
+    monkeypatch.setattr(vton, "_gemini_post_json", fake_post)
+    result = await vton.generate_try_on([io.BytesIO(sample_image_bytes)], [io.BytesIO(sample_image_bytes)])
+
+    assert result["image_url"].startswith("data:image/")
+    assert ["gemini-3-pro-image-preview" in u for u in urls] == [True, False]
+    assert "/gemini-alt-image:" in urls[1]
+
+
+@pytest.mark.asyncio
+async def test_intimate_vision_check_skipped_for_non_intimate_category(monkeypatch, sample_image_bytes):
+    from services import vton
+
+    posts = []
+
+    async def fake_post(_client, *, url, headers, payload):
+        posts.append(payload)
+        return DummyGeminiResponse(
+            ok=True,
+            data={"candidates": [{"finishReason": "STOP", "content": {"parts": [{"inline_data": {"data": "AAAA", "mime_type": "image/png"}}]}}]},
+        )
+
+    monkeypatch.setattr(vton, "_gemini_post_json", fake_post)
+    result = await vton.generate_try_on(
+        [io.BytesIO(sample_image_bytes)], [io.BytesIO(sample_image_bytes)], category="shoes"
+    )
+
+    assert result["image_url"].startswith("data:image/")
+    assert len(posts) == 1 and "responseModalities" in posts[0]["generationConfig"]